@@ -0,0 +1,144 @@
+# Admission control for stream clients, so casual viewers can never starve
+# the operator's headset of CPU or uplink.
+#
+# Clients fall into priority classes, picked by token (?token=...) or path
+# prefix (/operator/stream1.mjpg). As the number of streams grows, the lower
+# classes are throttled first; at the limits a new client takes the place
+# of the newest lower-class stream, or is refused if there is none.
+#
+# Front-end worker processes share one SharedCounts, so the limits hold
+# across all of them; a client can only displace streams in its own worker.
+
+import time
+from contextlib import nullcontext
+from threading import Lock
+from urllib.parse import parse_qs
+
+CLASSES = ('operator', 'observer', 'dashboard')
+
+# class: (load at which it is throttled, fps it is throttled to)
+DEGRADE = {
+    'observer': (0.75, 10),
+    'dashboard': (0.5, 2),
+}
+
+
+class Ticket:
+    def __init__(self, camera, cls):
+        self.camera = camera
+        self.cls = cls
+        self.started = time.monotonic()
+        self.evicted = False
+        self.pacer = None
+
+
+class SharedCounts:
+    # Streams per camera (1, 2) and in total (0), in shared memory; make it
+    # before forking the processes that use it.
+    def __init__(self, ctx, cameras=2):
+        self.lock = ctx.Lock()
+        self.counts = ctx.Array('i', cameras + 1, lock=False)
+
+
+class Admission:
+    def __init__(self, per_camera_limit=6, global_limit=10, tokens=None, classes=CLASSES, degrade=DEGRADE,
+                 shared=None):
+        self.per_camera_limit = per_camera_limit
+        self.global_limit = global_limit
+        self.tokens = tokens or {}
+        self.classes = classes
+        self.degrade = degrade
+        self.shared = shared
+        self.tickets = []
+        self.refused = {cls: 0 for cls in classes}
+        self.evicted = {cls: 0 for cls in classes}
+        self.lock = Lock()
+
+    def classify(self, path, query=''):
+        token = parse_qs(query).get('token', [None])[0]
+        if token in self.tokens:
+            cls = self.tokens[token]
+        else:
+            cls = self.classes[-1]
+        for name in self.classes:
+            prefix = '/' + name + '/'
+            if path.startswith(prefix):
+                path = path[len(prefix) - 1:]
+                # A class that has tokens can't be claimed by path alone.
+                if name not in self.tokens.values() and self.rank(name) < self.rank(cls):
+                    cls = name
+        return cls, path
+
+    def rank(self, cls):
+        return self.classes.index(cls)
+
+    def locked(self):
+        return self.shared.lock if self.shared is not None else nullcontext()
+
+    def count(self, camera=0):
+        # Streams on camera, or on all cameras for 0.
+        if self.shared is not None:
+            return self.shared.counts[camera]
+        return sum(1 for t in self.tickets if t.camera == camera) if camera else len(self.tickets)
+
+    def adjust(self, camera, delta):
+        if self.shared is not None:
+            self.shared.counts[camera] += delta
+            self.shared.counts[0] += delta
+
+    def acquire(self, camera, cls):
+        with self.lock, self.locked():
+            on_camera = [t for t in self.tickets if t.camera == camera]
+            if self.count(camera) >= self.per_camera_limit:
+                candidates = on_camera
+            elif self.count() >= self.global_limit:
+                candidates = self.tickets
+            else:
+                candidates = None
+
+            if candidates is not None:
+                victim = max(candidates, key=lambda t: (self.rank(t.cls), t.started), default=None)
+                if victim is None or self.rank(victim.cls) <= self.rank(cls):
+                    self.refused[cls] += 1
+                    return None
+                victim.evicted = True
+                self.tickets.remove(victim)
+                self.adjust(victim.camera, -1)
+                self.evicted[victim.cls] += 1
+
+            ticket = Ticket(camera, cls)
+            self.tickets.append(ticket)
+            self.adjust(camera, 1)
+            return ticket
+
+    def release(self, ticket):
+        with self.lock, self.locked():
+            if ticket in self.tickets:
+                self.tickets.remove(ticket)
+                self.adjust(ticket.camera, -1)
+
+    def max_fps(self, cls):
+        if cls not in self.degrade:
+            return None
+        threshold, fps = self.degrade[cls]
+        if self.count() / self.global_limit < threshold:
+            return None
+        return fps
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for cls in self.classes:
+                tickets = [t for t in self.tickets if t.cls == cls]
+                cameras = {}
+                for ticket in tickets:
+                    cameras[ticket.camera] = cameras.get(ticket.camera, 0) + 1
+                stats[cls] = {
+                    'active': len(tickets),
+                    'cameras': cameras,
+                    'max_fps': self.max_fps(cls),
+                    'refused': self.refused[cls],
+                    'evicted': self.evicted[cls],
+                    'clients': [dict(camera=t.camera, **t.pacer.stats()) for t in tickets if t.pacer is not None],
+                }
+            return stats
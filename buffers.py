@@ -0,0 +1,125 @@
+# Reusable frame buffers and a per-frame allocation counter, so the
+# capture -> process -> encode -> publish path can be checked for churn.
+#
+# The frame loop calls frame() once per frame. What's measured there sees
+# every allocation, not just the ones call sites report with allocated():
+#
+#   - retained_blocks_per_frame, the growth in Python's allocated blocks
+#     (sys.getallocatedblocks()) over all frames, is cheap and always on.
+#     It is net: it catches anything kept per frame, a leak, but a buffer
+#     allocated and freed within the frame reads as 0;
+#   - churn needs TRACEMALLOC=1: peak_bytes_per_frame is how far each
+#     frame's allocations rose above the level at its start, numpy buffers
+#     included, so a per-frame temporary shows up there even though it's
+#     freed. stats() also lists the source lines whose allocations grew
+#     most since the last stats(). tracemalloc slows every allocation
+#     down, so it's for investigating.
+
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+TRACEMALLOC = os.environ.get('TRACEMALLOC') == '1'
+TOP_GROWTH = 5
+
+
+class AllocationTracker:
+    def __init__(self, trace=TRACEMALLOC):
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.allocations = 0
+        self.allocated_bytes = 0
+        self.first_blocks = None
+        self.last_blocks = None
+        self.trace = trace
+        self.frame_start = None
+        self.peak_bytes = 0
+        self.snapshot = None
+        self.gc_collections = 0
+        self.gc_seconds = 0.0
+        self.gc_started = None
+        gc.callbacks.append(self.on_gc)
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_started = time.perf_counter()
+        elif self.gc_started is not None:
+            self.gc_seconds += time.perf_counter() - self.gc_started
+            self.gc_collections += 1
+            self.gc_started = None
+
+    def frame(self):
+        blocks = sys.getallocatedblocks()
+        with self.lock:
+            if self.first_blocks is None:
+                self.first_blocks = blocks
+            self.last_blocks = blocks
+            self.frames += 1
+            if self.trace:
+                current, peak = tracemalloc.get_traced_memory()
+                if self.frame_start is not None:
+                    self.peak_bytes += max(peak - self.frame_start, 0)
+                tracemalloc.reset_peak()
+                self.frame_start = current
+
+    def allocated(self, nbytes):
+        with self.lock:
+            self.allocations += 1
+            self.allocated_bytes += nbytes
+
+    def top_growth(self):
+        # Source lines whose live allocations grew most since the last call.
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ])
+        previous, self.snapshot = self.snapshot, snapshot
+        if previous is None:
+            return []
+        return [{'line': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                 'bytes': stat.size_diff, 'blocks': stat.count_diff}
+                for stat in snapshot.compare_to(previous, 'lineno')[:TOP_GROWTH]]
+
+    def stats(self):
+        top_growth = self.top_growth() if self.trace else None
+        with self.lock:
+            frames = max(self.frames, 1)
+            return {
+                'frames': self.frames,
+                'retained_blocks_per_frame': round((self.last_blocks - self.first_blocks) / frames, 2)
+                if self.first_blocks is not None else None,
+                'allocated_blocks': sys.getallocatedblocks(),
+                'peak_bytes_per_frame': self.peak_bytes // frames if self.trace else None,
+                'top_growth': top_growth,
+                # Only what call sites report with allocated().
+                'reported_allocations_per_frame': round(self.allocations / frames, 2),
+                'reported_bytes_per_frame': self.allocated_bytes // frames,
+                'gc_collections': self.gc_collections,
+                'gc_ms': round(self.gc_seconds * 1000, 1),
+            }
+
+
+tracker = AllocationTracker()
+
+
+class ArrayPool:
+    # Arrays are kept per thread, so handler threads never share a buffer.
+    def __init__(self, tracker=tracker):
+        self.tracker = tracker
+        self.local = threading.local()
+
+    def get(self, name, shape, dtype=np.uint8):
+        arrays = self.local.__dict__.setdefault('arrays', {})
+        array = arrays.get(name)
+        if array is None or array.shape != tuple(shape) or array.dtype != dtype:
+            array = np.empty(shape, dtype)
+            arrays[name] = array
+            self.tracker.allocated(array.nbytes)
+        return array
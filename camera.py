@@ -3,18 +3,24 @@
 # This is the same as mjpeg_server.py, but uses the h/w MJPEG encoder.
 
 import io
+import json
 import logging
 import socketserver
 from http import server
 from threading import Condition
 
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
+from picamera2 import MappedArray, Picamera2
 from picamera2.outputs import FileOutput
 
 from libcamera import Transform
 from libcamera import Rectangle
 
+from change_gate import ChangeGate
+from encoder_profile import PROFILES, start_encoder
+from main_stream import main_config, memory_stats
+import sensor_mode
+from stream_watchdog import SEND_TIMEOUT, Watchdog
+
 PAGE = """\
 <html>
 <head>
@@ -59,17 +65,42 @@ PAGE = """\
 </body>
 </html>"""
 
+# Streaming clients that get no frame for this long are disconnected.
+STALL_SECONDS = 30
+# Hardware encoder bitrate and frame rate, see encoder_profile.PROFILES.
+ENCODER_PROFILE = 'normal'
+# main is never read here; 'low' shrinks it to the lores size so its
+# buffers don't take CMA memory (see main_stream.py).
+MAIN_STREAM = 'low'
+CHANGE_GATE = True
+KEEPALIVE_FPS = 1.0
+LORES_SIZE = (960, 720)
+
+watchdog = Watchdog(STALL_SECONDS)
+
 class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
+    def __init__(self, gate=None):
         self.frame = None
         self.condition = Condition()
+        self.gate = gate
 
     def write(self, buf):
+        if self.gate is not None and not self.gate.admit():
+            return
         with self.condition:
             self.frame = buf
             self.condition.notify_all()
 
+
+def watch_scene(output):
+    def callback(request):
+        with MappedArray(request, 'lores') as m:
+            output.gate.observe(m.array[:LORES_SIZE[1]])
+    return callback
+
 class StreamingHandler(server.BaseHTTPRequestHandler):
+    timeout = SEND_TIMEOUT
+
     def do_GET(self):
         if self.path == '/':
             self.send_response(301)
@@ -90,16 +121,18 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
             try:
-                while True:
-                    with output1.condition:
-                        output1.condition.wait()
-                        frame = output1.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
+                with watchdog.watch(self) as watch:
+                    while True:
+                        with output1.condition:
+                            watch.wait(output1.condition)
+                            frame = output1.frame
+                        self.wfile.write(b'--FRAME\r\n')
+                        self.send_header('Content-Type', 'image/jpeg')
+                        self.send_header('Content-Length', len(frame))
+                        self.end_headers()
+                        self.wfile.write(frame)
+                        self.wfile.write(b'\r\n')
+                        watch.progress()
             except Exception as e:
                 logging.warning(
                     'Removed streaming client %s: %s',
@@ -112,20 +145,34 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
             try:
-                while True:
-                    with output2.condition:
-                        output2.condition.wait()
-                        frame = output2.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
+                with watchdog.watch(self) as watch:
+                    while True:
+                        with output2.condition:
+                            watch.wait(output2.condition)
+                            frame = output2.frame
+                        self.wfile.write(b'--FRAME\r\n')
+                        self.send_header('Content-Type', 'image/jpeg')
+                        self.send_header('Content-Length', len(frame))
+                        self.end_headers()
+                        self.wfile.write(frame)
+                        self.wfile.write(b'\r\n')
+                        watch.progress()
             except Exception as e:
                 logging.warning(
                     'Removed streaming client %s: %s',
                     self.client_address, str(e))
+        elif self.path == '/stats':
+            content = json.dumps({
+                'handlers': watchdog.stats(),
+                'gates': {'stream1': output1.gate and output1.gate.stats(), 'stream2': output2.gate and output2.gate.stats()},
+                'memory': {'stream1': memory_stats(picam1, profile.fps), 'stream2': memory_stats(picam2, profile.fps)},
+                'sensor_modes': sensor_mode.chosen,
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
         else:
             self.send_error(404)
             self.end_headers()
@@ -136,33 +183,38 @@ class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     daemon_threads = True
 
 
+profile = PROFILES[ENCODER_PROFILE]
+main = main_config(MAIN_STREAM, LORES_SIZE)
+
 picam1 = Picamera2(0)
-picam1.options["quality"] = 60
-picam1.video_configuration.controls.FrameRate = 25.0
 picam1.configure(picam1.create_video_configuration(
         buffer_count = 3,
         queue = False,
-        main={"size": (1640, 1232),"format": "YUV420"},
-        lores={"size": (960, 720)},
+        main=main,
+        lores={"size": LORES_SIZE},
         encode="lores",
         display="lores",
-        transform=Transform(rotation=90)))
-output1 = StreamingOutput()
-picam1.start_recording(MJPEGEncoder(), FileOutput(output1))
+        transform=Transform(rotation=90),
+        **sensor_mode.select(picam1, main['size'], profile.fps, name='stream1')))
+output1 = StreamingOutput(ChangeGate(keepalive_fps=KEEPALIVE_FPS) if CHANGE_GATE else None)
+if output1.gate is not None:
+    picam1.pre_callback = watch_scene(output1)
+start_encoder(picam1, profile, FileOutput(output1))
 
 picam2 = Picamera2(1)
-picam2.options["quality"] = 60
-picam2.video_configuration.controls.FrameRate = 25.0
 picam2.configure(picam2.create_video_configuration(
         buffer_count = 3,
         queue = False,
-        main={"size": (1640, 1232),"format": "YUV420"},
-        lores={"size": (960, 720)},
+        main=main,
+        lores={"size": LORES_SIZE},
         encode="lores",
         display="lores",
-        transform=Transform(rotation=270)))
-output2 = StreamingOutput()
-picam2.start_recording(MJPEGEncoder(), FileOutput(output2))
+        transform=Transform(rotation=270),
+        **sensor_mode.select(picam2, main['size'], profile.fps, name='stream2')))
+output2 = StreamingOutput(ChangeGate(keepalive_fps=KEEPALIVE_FPS) if CHANGE_GATE else None)
+if output2.gate is not None:
+    picam2.pre_callback = watch_scene(output2)
+start_encoder(picam2, profile, FileOutput(output2))
 
 try:
     address = ('', 8000)
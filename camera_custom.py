@@ -1,61 +1,58 @@
 #!/usr/bin/python3
 
 import io
-import logging
+import json
 import socketserver
+import time
 from http import server
 from threading import Condition
 from urllib.parse import parse_qs
 
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
+from picamera2 import MappedArray, Picamera2
 from picamera2.outputs import FileOutput
 
 from libcamera import Transform
 
-PAGE_TEMPLATE = """\
+from admission import Admission
+from change_gate import ChangeGate
+from encoder_profile import PROFILES, start_encoder
+from main_stream import main_config, memory_stats
+from mjpeg_stream import serve_stream
+import sensor_mode
+from stream_watchdog import SEND_TIMEOUT, Watchdog
+from viewport import CENTRED_OFFSET, VIEW_SIZE, scaler_crop
+
+PAGE = """\
 <html>
 <head>
 <title>Picamera2 MJPEG Streaming Demo</title>
 <style>
-  body {{
+  body {
     background: black;
     margin: 0;
     display: flex;
     justify-content: center;
     align-items: center;
     height: 100vh;
-  }}
-  .case {{
+  }
+  .case {
     display: flex;
-  }}
-  .box {{
-    overflow: hidden;
-    position: relative;
-    border: 0px solid grey;
-  }}
-  .hori_1 {{
+  }
+  .box {
     width: 400px;
     height: 400px;
-  }}
-  .hori_1 img {{
-    position: absolute;
-    left: -{left_value}%;
-    transform: rotate(90deg);
-    width: auto;
+    border: 0px solid grey;
+  }
+  .box img {
+    width: 100%;
     height: 100%;
-  }}
-  .hori_2 {{
-    width: 400px;
-    height: 400px;
-  }}
-  .hori_2 img {{
-    position: absolute;
-    right: -{right_value}%;
+  }
+  .hori_1 img {
+    transform: rotate(90deg);
+  }
+  .hori_2 img {
     transform: rotate(270deg);
-    width: auto;
-    height: 100%;
-  }}
+  }
 </style>
 </head>
 <body>
@@ -73,52 +70,100 @@ PAGE_TEMPLATE = """\
 left_value = 17
 right_value = 17
 
+LORES_SIZE = VIEW_SIZE
+CHANGE_GATE = True
+KEEPALIVE_FPS = 1.0
+STREAM_LIMIT_PER_CAMERA = 6
+STREAM_LIMIT = 10
+# token: class, e.g. {'change-me': 'operator'}; classes with a token can't be
+# claimed through the path prefix alone.
+STREAM_TOKENS = {}
+# Streaming clients that get no frame for this long are disconnected.
+STALL_SECONDS = 30
+# Hardware encoder bitrate and frame rate, see encoder_profile.PROFILES.
+ENCODER_PROFILE = 'normal'
+# main is never read here; 'low' shrinks it to the lores size so its
+# buffers don't take CMA memory (see main_stream.py).
+MAIN_STREAM = 'low'
+
+admission = Admission(STREAM_LIMIT_PER_CAMERA, STREAM_LIMIT, STREAM_TOKENS)
+watchdog = Watchdog(STALL_SECONDS)
+
 
 class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
+    def __init__(self, gate=None):
         self.frame = None
+        self.frame_id = None
+        self.timestamp = None
         self.condition = Condition()
+        self.gate = gate
+        self.frames = 0
+        self.clients = 0
+        self.sent = 0
 
     def write(self, buf):
+        if self.gate is not None and not self.gate.admit():
+            return
         with self.condition:
             self.frame = buf
+            self.timestamp = time.monotonic()
+            self.frames += 1
+            self.frame_id = self.frames
             self.condition.notify_all()
 
+    def stats(self):
+        stats = {'frames': self.frames}
+        if self.gate is not None:
+            stats['gate'] = self.gate.stats()
+        return stats
+
+
+def apply_crop(picam, shift_percent, rotation):
+    full = picam.camera_controls['ScalerCrop'][1]
+    picam.set_controls({"ScalerCrop": scaler_crop(full, shift_percent, rotation)})
+
+
+def watch_scene(output):
+    def callback(request):
+        with MappedArray(request, 'lores') as m:
+            output.gate.observe(m.array[:LORES_SIZE[1]])
+    return callback
+
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
+    timeout = SEND_TIMEOUT
+
     def do_GET(self):
+        path, _, query = self.path.partition('?')
+        cls, path = admission.classify(path, query)
         if self.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
             self.end_headers()
         elif self.path == '/index.html':
-            content = PAGE_TEMPLATE.format(left_value=left_value, right_value=right_value).encode('utf-8')
+            content = PAGE.encode('utf-8')
             self.send_response(200)
             self.send_header('Content-Type', 'text/html')
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
-        elif self.path in ['/stream1.mjpg', '/stream2.mjpg']:
+        elif path in ['/stream1.mjpg', '/stream2.mjpg']:
+            output = output1 if path == '/stream1.mjpg' else output2
+            serve_stream(self, output, 1 if path == '/stream1.mjpg' else 2, cls, query, admission, watchdog)
+        elif self.path == '/stats':
+            content = json.dumps({
+                'stream1': output1.stats(),
+                'stream2': output2.stats(),
+                'admission': admission.stats(),
+                'handlers': watchdog.stats(),
+                'memory': {'stream1': memory_stats(picam1, profile.fps), 'stream2': memory_stats(picam2, profile.fps)},
+                'sensor_modes': sensor_mode.chosen,
+            }).encode('utf-8')
             self.send_response(200)
-            self.send_header('Age', 0)
-            self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
             self.end_headers()
-            try:
-                output = output1 if self.path == '/stream1.mjpg' else output2
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-            except Exception as e:
-                logging.warning('Removed streaming client %s: %s', self.client_address, str(e))
+            self.wfile.write(content)
         else:
             self.send_error(404)
             self.end_headers()
@@ -131,6 +176,8 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             global left_value, right_value
             left_value = int(params.get('left', [left_value])[0])
             right_value = int(params.get('right', [right_value])[0])
+            apply_crop(picam1, left_value - CENTRED_OFFSET, 90)
+            apply_crop(picam2, CENTRED_OFFSET - right_value, 270)
             self.send_response(200)
             self.end_headers()
             self.wfile.write(b'Values updated')
@@ -144,29 +191,40 @@ class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     daemon_threads = True
 
 
+profile = PROFILES[ENCODER_PROFILE]
+main = main_config(MAIN_STREAM, LORES_SIZE)
+
 picam1 = Picamera2(0)
 picam1.configure(picam1.create_video_configuration(
     buffer_count=3,
-    main={"size": (1640, 1232), "format": "YUV420"},
-    lores={"size": (960, 720)},
+    main=main,
+    lores={"size": LORES_SIZE},
     encode="lores",
     display="lores",
-    transform=Transform(rotation=90)
+    transform=Transform(rotation=90),
+    **sensor_mode.select(picam1, main['size'], profile.fps, name='stream1')
 ))
-output1 = StreamingOutput()
-picam1.start_recording(MJPEGEncoder(), FileOutput(output1))
+apply_crop(picam1, left_value - CENTRED_OFFSET, 90)
+output1 = StreamingOutput(ChangeGate(keepalive_fps=KEEPALIVE_FPS) if CHANGE_GATE else None)
+if output1.gate is not None:
+    picam1.pre_callback = watch_scene(output1)
+start_encoder(picam1, profile, FileOutput(output1))
 
 picam2 = Picamera2(1)
 picam2.configure(picam2.create_video_configuration(
     buffer_count=3,
-    main={"size": (1640, 1232), "format": "YUV420"},
-    lores={"size": (960, 720)},
+    main=main,
+    lores={"size": LORES_SIZE},
     encode="lores",
     display="lores",
-    transform=Transform(rotation=270)
+    transform=Transform(rotation=270),
+    **sensor_mode.select(picam2, main['size'], profile.fps, name='stream2')
 ))
-output2 = StreamingOutput()
-picam2.start_recording(MJPEGEncoder(), FileOutput(output2))
+apply_crop(picam2, CENTRED_OFFSET - right_value, 270)
+output2 = StreamingOutput(ChangeGate(keepalive_fps=KEEPALIVE_FPS) if CHANGE_GATE else None)
+if output2.gate is not None:
+    picam2.pre_callback = watch_scene(output2)
+start_encoder(picam2, profile, FileOutput(output2))
 
 try:
     address = ('', 8000)
@@ -1,75 +1,168 @@
 #!/usr/bin/python3
 
 import io
+import json
 import logging
+import os
 import socketserver
-import cv2
-import numpy as np
+import time
 
 from http import server
-from threading import Condition
+from threading import Condition, Thread
 from urllib.parse import parse_qs
 
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
-from picamera2.outputs import FileOutput
-
-from libcamera import Transform
-
-PAGE_TEMPLATE = """\
+try:
+    from picamera2 import MappedArray, Picamera2
+    from picamera2.outputs import FileOutput
+
+    from libcamera import Transform
+except ImportError:
+    # Replaying a recording needs no camera stack, so it runs on any box.
+    Picamera2 = FileOutput = None
+
+from admission import Admission
+from buffers import tracker
+from depth import DepthStream, StereoCalibration
+from change_gate import ChangeGate
+from distort_pool import DistortionPool
+from distortion import BarrelDistorter, LensProfile
+from encoder_profile import PROFILES, BitrateController, Camera, start_encoder
+from frame_bus import FrameBus
+from frontend import FrontEnd
+from gl_distortion import GL_PAGE, LensFeed, lens_settings
+import jpeg_encoder
+from luma import GrayStream
+from main_stream import HqStream, main_config, memory_stats
+from mjpeg_stream import serve_stream
+from recorder import Recorder, ReplayCamera
+import sensor_mode
+from roi import RoiStream, ViewTracker, display_rect, roi_rect
+from stream_watchdog import SEND_TIMEOUT, Watchdog
+from tracing import Tracer, TraceWriter, now
+from viewport import CENTRED_OFFSET, VIEW_SIZE, scaler_crop
+
+PAGE = """\
 <html>
 <head>
 <title>Mand.ro Picamera2 MJPEG Streaming</title>
 <style>
-  body {{
+  body {
     background: black;
     margin: 0;
     display: flex;
     justify-content: center;
     align-items: center;
     height: 100vh;
-  }}
-  .case {{
+  }
+  .case {
     display: flex;
-  }}
-  .box {{
-    overflow: hidden;
-    position: relative;
-    border: 0px solid grey;
-  }}
-  .hori_1 {{
+  }
+  .box {
     width: 400px;
     height: 400px;
-  }}
-  .hori_1 img {{
-    position: absolute;
-    left: {left_value}% ;
-    transform: rotate(90deg);
-    width: auto;
+    border: 0px solid grey;
+  }
+  .box img {
+    width: 100%;
     height: 100%;
-  }}
-  .hori_2 {{
+  }
+  .hori_1 img {
+    transform: rotate(90deg);
+  }
+  .hori_2 img {
+    transform: rotate(270deg);
+  }
+</style>
+</head>
+<body>
+<div class="case">
+    <div class="box hori_1">
+        <img src="stream1.mjpg">
+    </div>
+    <div class="box hori_2">
+        <img src="stream2.mjpg">
+    </div>
+</div>
+</body>
+</html>"""
+
+ROI_PAGE = """\
+<html>
+<head>
+<title>Mand.ro Picamera2 ROI Streaming</title>
+<style>
+  body {
+    background: black;
+    margin: 0;
+    display: flex;
+    justify-content: center;
+    align-items: center;
+    height: 100vh;
+  }
+  .case {
+    display: flex;
+  }
+  .box {
     width: 400px;
     height: 400px;
-  }}
-  .hori_2 img {{
+    position: relative;
+    overflow: hidden;
+  }
+  .box img {
+    width: 100%;
+    height: 100%;
+  }
+  .roi {
     position: absolute;
-    right: {right_value}% ;
+  }
+  .hori_1 img {
+    transform: rotate(90deg);
+  }
+  .hori_2 img {
     transform: rotate(270deg);
-    width: auto;
-    height: 100%;
-  }}
+  }
 </style>
 </head>
 <body>
 <div class="case">
     <div class="box hori_1">
         <img src="stream1.mjpg">
+        <div class="roi" id="roi1"><img src="roi1.mjpg"></div>
     </div>
     <div class="box hori_2">
         <img src="stream2.mjpg">
+        <div class="roi" id="roi2"><img src="roi2.mjpg"></div>
     </div>
 </div>
+<script>
+function place(id, rect) {
+  var roi = document.getElementById(id);
+  roi.style.left = (rect[0] * 100) + '%';
+  roi.style.top = (rect[1] * 100) + '%';
+  roi.style.width = (rect[2] * 100) + '%';
+  roi.style.height = (rect[3] * 100) + '%';
+}
+var busy = false;
+function look(x, y) {
+  if (busy) return;
+  busy = true;
+  fetch('/view', {method: 'POST', body: 'x=' + x + '&y=' + y})
+    .then(function (r) { return r.json(); })
+    .then(function (rects) { place('roi1', rects.stream1); place('roi2', rects.stream2); })
+    .finally(function () { busy = false; });
+}
+document.querySelectorAll('.box').forEach(function (box) {
+  box.addEventListener('mousemove', function (e) {
+    var r = box.getBoundingClientRect();
+    look((e.clientX - r.left) / r.width, (e.clientY - r.top) / r.height);
+  });
+});
+window.addEventListener('deviceorientation', function (e) {
+  if (e.gamma === null) return;
+  look(0.5 + e.gamma / 90, 0.5 - (e.beta - 90) / 90);
+});
+look(0.5, 0.5);
+</script>
 </body>
 </html>"""
 
@@ -77,118 +170,402 @@ left_value = 17
 right_value = 17
 distorted = False
 
-def crop_to_square(image):
-    height, width = image.shape[:2]
-    size = min(width, height)
-    x_center, y_center = width // 2, height // 2
-    x_start = max(0, x_center - size // 2)
-    y_start = max(0, y_center - size // 2)
-    return image[y_start:y_start + size, x_start:x_start + size]
+LORES_SIZE = VIEW_SIZE
+# main matches the square ScalerCrop so the ROI is cut without stretching.
+MAIN_SIZE = (1232, 1232)
+# hq: main is full size, feeding the ROI streams and /hq1.mjpg and
+# /hq2.mjpg (every HQ_FPS'th frame, encoded only while watched). low: main
+# shrinks to the lores size to free CMA memory and ISP bandwidth, and
+# those streams are off. See main_stream.py.
+MAIN_STREAM = os.environ.get('MAIN_STREAM', 'hq')
+HQ_FPS = 5.0
+ROI_SIZE = (512, 512)
+STREAM_LIMIT_PER_CAMERA = 6
+STREAM_LIMIT = 10
+# token: class, e.g. {'change-me': 'operator'}; classes with a token can't be
+# claimed through the path prefix alone.
+STREAM_TOKENS = {}
+CHANGE_GATE = True
+KEEPALIVE_FPS = 1.0
+# Worker processes for the distorted streams; 0 distorts in this process.
+DISTORTION_WORKERS = 3
+# JSON lens profile (per-channel k1/k2, rotation, output_size); None uses
+# the default coefficients for every channel.
+LENS_PROFILE = None
+# Record the served frames to <RECORD_DIR>/stream1 and stream2, or serve a
+# recording from <REPLAY_DIR> instead of the cameras. REPLAY_SPEED 0 replays
+# as fast as possible.
+RECORD_DIR = os.environ.get('RECORD_DIR')
+REPLAY_DIR = os.environ.get('REPLAY_DIR')
+REPLAY_SPEED = float(os.environ.get('REPLAY_SPEED', '1'))
+# Streaming clients that get no frame for this long are disconnected.
+STALL_SECONDS = 30
+# Serve viewers from this many worker processes sharing port 8000 (needs
+# FRAME_BUS); this process then only listens on CONTROL_ADDRESS, which the
+# workers forward everything but the pages and streams to.
+FRONTEND_WORKERS = int(os.environ.get('FRONTEND_WORKERS', '0'))
+# Publish each camera's JPEG and raw lores (I420) frames to shared memory
+# as mandro_stream1_jpeg, mandro_stream1_lores, ...; read with
+# frame_bus.FrameBusReader. Off unless FRAME_BUS=1 or there are front-end
+# workers, since every bus is a segment in /dev/shm; even then a frame is
+# only copied in while a reader is attached.
+FRAME_BUS = os.environ.get('FRAME_BUS') == '1' or FRONTEND_WORKERS > 0
+FRAME_BUS_SLOTS = 4
+FRAME_BUS_JPEG_SIZE = 512 * 1024
+CONTROL_ADDRESS = ('127.0.0.1', 8001)
+# Hardware encoder profile per camera (see encoder_profile.PROFILES), and the
+# uplink available to viewers in bits/s that the bitrates are scaled to fit;
+# None keeps the profile bitrates.
+ENCODER_PROFILES = {'stream1': 'normal', 'stream2': 'normal'}
+UPLINK_CAPACITY = 20_000_000
+# Disparity from the two cameras' lores frames (see depth.py), served as a
+# colourised /depth.mjpg and as raw int16 frames on mandro_depth_disparity,
+# and only computed while either has someone watching. STEREO_CALIBRATION
+# is a JSON stereo calibration; None takes the pair as rectified.
+DEPTH = os.environ.get('DEPTH') == '1'
+STEREO_CALIBRATION = None
+# Trace the stages of every TRACE_SAMPLE_EVERY'th frame (see tracing.py):
+# GET /trace for what's buffered, and with TRACE_FILE set, the last
+# TRACE_INTERVAL seconds are written there that often, rotated to .1 .. .5.
+TRACE = os.environ.get('TRACE') == '1'
+TRACE_SAMPLE_EVERY = int(os.environ.get('TRACE_SAMPLE_EVERY', '10'))
+TRACE_FILE = os.environ.get('TRACE_FILE')
+TRACE_INTERVAL = 10.0
+
+admission = Admission(STREAM_LIMIT_PER_CAMERA, STREAM_LIMIT, STREAM_TOKENS)
+profile = LensProfile.load(LENS_PROFILE) if LENS_PROFILE else LensProfile()
+frontend = None
+if FRONTEND_WORKERS and FRAME_BUS:
+    frontend = FrontEnd(FRONTEND_WORKERS, ('', 8000), CONTROL_ADDRESS,
+                        {'/index.html': PAGE, '/roi.html': ROI_PAGE, '/distorted.html': GL_PAGE},
+                        STREAM_LIMIT_PER_CAMERA, STREAM_LIMIT, STREAM_TOKENS)
+distorter = BarrelDistorter(profile)
+# Created before the cameras so the workers fork without their threads.
+pool = DistortionPool(DISTORTION_WORKERS, profile) if DISTORTION_WORKERS else None
+watchdog = Watchdog(STALL_SECONDS)
+tracer = Tracer(TRACE, TRACE_SAMPLE_EVERY)
+trace_writer = TraceWriter(tracer, TRACE_FILE, TRACE_INTERVAL) if TRACE and TRACE_FILE else None
+# Lens settings for /distorted.html, which warps the plain streams in the
+# browser. k1/k2/rotation posted to /update retune it live; the server-side
+# distorted streams keep LENS_PROFILE.
+client_profile = profile
+lens_feed = LensFeed(lens_settings(client_profile, distorted))
 
 
 class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
+    def __init__(self, gate=None):
+        self.name = None
         self.frame = None
+        self.frame_id = None
+        self.timestamp = None
         self.condition = Condition()
-
-    def write(self, buf):
+        self.gate = gate
+        self.frames = 0
+        self.bytes = 0
+        self.sent = 0
+        self.clients = 0
+        self.recorder = None
+        self.bus = None
+        # One output counts frames for the allocation tracker.
+        self.frame_clock = False
+        # Set by SensorTimedOutput just before each write.
+        self.sensor_us = None
+
+    def write(self, buf, frame_id=None):
+        # frame_id: the frame this one was made from, for tracing; camera
+        # frames are identified by sensor timestamp, others by count.
+        if frame_id is None:
+            frame_id = self.sensor_us if self.sensor_us is not None else self.frames + 1
+        started = now() if tracer.sampled(frame_id) else None
+        if self.frame_clock:
+            tracker.frame()
+        if self.gate is not None and not self.gate.admit():
+            return
+        if self.recorder is not None:
+            self.recorder.write(buf)
+        if self.bus is not None and self.bus.has_readers():
+            self.bus.publish(buf)
         with self.condition:
+            locked = now() if started is not None else None
             self.frame = buf
+            self.frame_id = frame_id
+            self.timestamp = time.monotonic()
+            self.frames += 1
+            self.bytes += len(buf)
             self.condition.notify_all()
+        if started is not None:
+            if self.sensor_us is not None:
+                tracer.async_span('capture+encode', self.sensor_us * 1000, started, stream=self.name, frame=frame_id)
+            tracer.span('write', started, now(), stream=self.name, frame=frame_id, bytes=len(buf),
+                        lock_wait_us=(locked - started) // 1000)
+
+    def wanted(self):
+        # Viewers here, or front-end workers reading the bus.
+        return self.clients > 0 or self.bus is not None and self.bus.has_readers()
+
+    def stats(self):
+        stats = {'frames': self.frames, 'clients': self.clients}
+        if self.gate is not None:
+            stats['gate'] = self.gate.stats()
+        return stats
+
+
+if FileOutput is not None:
+    class SensorTimedOutput(FileOutput):
+        # Tells the output which sensor frame it's about to be given.
+        # picamera2 passes encoders' timestamps relative to their first
+        # frame; without that base the output counts frames instead.
+        def __init__(self, output):
+            super().__init__(output)
+            self.output = output
+            self.encoder = None
+
+        def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+            first = getattr(self.encoder, 'firsttimestamp', None)
+            if tracer.enabled and timestamp is not None and first is not None:
+                self.output.sensor_us = first + timestamp
+            super().outputframe(frame, keyframe, timestamp, *args, **kwargs)
+
+
+def apply_crop(picam, shift_percent, rotation):
+    full = picam.camera_controls['ScalerCrop'][1]
+    picam.set_controls({"ScalerCrop": scaler_crop(full, shift_percent, rotation)})
+
+
+def distort_stream(name, source, destination):
+    # One distortion per camera frame, shared by every distorted client.
+    while True:
+        with source.condition:
+            source.condition.wait()
+            frame = source.frame
+            frame_id = source.frame_id
+        if not destination.wanted():
+            continue
+        started = now() if tracer.sampled(frame_id) else None
+        if pool is not None:
+            if started is None:
+                pool.submit(name, frame, lambda distorted: destination.write(distorted, frame_id))
+            else:
+                def delivered(distorted, frame_id=frame_id, started=started):
+                    tracer.async_span('distort', started, now(), stream=destination.name, frame=frame_id)
+                    destination.write(distorted, frame_id)
+                pool.submit(name, frame, delivered)
+        else:
+            distorted_frame = distorter.apply(frame)
+            if started is not None:
+                tracer.span('distort', started, now(), stream=destination.name, frame=frame_id)
+            destination.write(distorted_frame, frame_id)
+
+
+def lores_callback(output, bus, gray, camera):
+    # One mapping of the lores frame for the change gate, the frame bus,
+    # the ?mode=gray stream, which is the Y plane encoded as it lies (on
+    # GrayStream's thread), and the depth stream.
+    def callback(request):
+        sensor_ns = request.get_metadata()['SensorTimestamp']
+        frame_id = int(sensor_ns / 1000)
+        started = now() if tracer.sampled(frame_id) else None
+        with MappedArray(request, 'lores') as m:
+            if output.gate is not None:
+                output.gate.observe(m.array[:LORES_SIZE[1]])
+            if bus is not None and bus.has_readers():
+                bus.publish(m.array, b'I420')
+            if gray.wanted():
+                gray.submit(m.array[:LORES_SIZE[1], :LORES_SIZE[0]], frame_id)
+            if depth is not None and depth.wanted():
+                depth.submit(camera, m.array[:LORES_SIZE[1], :LORES_SIZE[0]], sensor_ns)
+        if started is not None:
+            tracer.async_span('sensor', sensor_ns, started, stream=output.name, frame=frame_id)
+            tracer.span('lores_callback', started, now(), stream=output.name, frame=frame_id)
+    return callback
+
+
+def lores_bus(picam, name):
+    if not FRAME_BUS:
+        return None
+    stride = picam.stream_configuration('lores')['stride']
+    return FrameBus(name, stride * LORES_SIZE[1] * 3 // 2, FRAME_BUS_SLOTS)
 
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
+    timeout = SEND_TIMEOUT
+
     def do_GET(self):
         if self.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
             self.end_headers()
         elif self.path == '/index.html':
-            adjusted_left_value = -left_value + (17 if distorted else 0)
-            adjusted_right_value = -right_value + (17 if distorted else 0)
-
-            content = PAGE_TEMPLATE.format(
-                left_value=adjusted_left_value,
-                right_value=adjusted_right_value
-            ).encode('utf-8')
-
+            content = PAGE.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif self.path == '/roi.html':
+            content = ROI_PAGE.encode('utf-8')
             self.send_response(200)
             self.send_header('Content-Type', 'text/html')
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
-        elif self.path.endswith('.mjpg'):
-            self.stream_video(self.path)
+        elif self.path == '/distorted.html':
+            content = GL_PAGE.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif self.path == '/lens':
+            self.stream_lens()
+        elif self.path.partition('?')[0].endswith('.mjpg'):
+            path, _, query = self.path.partition('?')
+            cls, path = admission.classify(path, query)
+            self.stream_video(path, cls, query)
+        elif self.path == '/trace':
+            # Chrome trace JSON: open in ui.perfetto.dev or chrome://tracing.
+            if not tracer.enabled:
+                self.send_error(404, 'Tracing is off; start with TRACE=1')
+                return
+            content = tracer.export().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Disposition', 'attachment; filename="trace.json"')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif self.path == '/stats':
+            content = json.dumps({
+                'stream1': output1.stats(),
+                'stream2': output2.stats(),
+                'distorted_stream1': distorted_output1.stats(),
+                'distorted_stream2': distorted_output2.stats(),
+                'roi1': roi1.stats(),
+                'roi2': roi2.stats(),
+                'gray_stream1': gray_output1.stats(),
+                'gray_stream2': gray_output2.stats(),
+                'gray1': gray1.stats(),
+                'gray2': gray2.stats(),
+                'depth': depth.stats() if depth is not None else None,
+                'hq1': hq1.stats() if hq1 is not None else None,
+                'hq2': hq2.stats() if hq2 is not None else None,
+                'memory': {'stream1': memory_stats(picam1, PROFILES[ENCODER_PROFILES['stream1']].fps),
+                           'stream2': memory_stats(picam2, PROFILES[ENCODER_PROFILES['stream2']].fps)}
+                if not REPLAY_DIR else None,
+                'sensor_modes': sensor_mode.chosen,
+                'trace': dict(tracer.stats(), writer=trace_writer.stats() if trace_writer is not None else None),
+                'jpeg': jpeg_encoder.stats(),
+                'distortion_pool': pool.stats() if pool is not None else None,
+                'lens_feed': lens_feed.stats(),
+                'admission': admission.stats(),
+                'allocations': tracker.stats(),
+                'handlers': watchdog.stats(),
+                'frontend': frontend.stats() if frontend is not None else None,
+                'encoder': controller.stats() if controller is not None else None,
+                'frame_bus': {bus.name: bus.stats() for bus in
+                              [o.bus for o in jpeg_outputs.values()] + [lores_bus1, lores_bus2, depth_bus]
+                              if bus is not None},
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
         else:
             self.send_error(404)
             self.end_headers()
 
-    def stream_video(self, path):
+    def stream_video(self, path, cls, query):
+        if path == '/depth.mjpg' and depth is None or path.startswith(('/roi', '/hq')) and not full_main:
+            self.send_error(404)
+            return
+        if path.startswith('/roi'):
+            output = roi_output1 if 'roi1' in path else roi_output2
+        elif path == '/depth.mjpg':
+            output = depth_output
+        elif path.startswith('/hq'):
+            output = hq_output1 if 'hq1' in path else hq_output2
+        elif parse_qs(query).get('mode') == ['gray'] and not REPLAY_DIR:
+            # Replays have no lores frames; gray clients get the recording.
+            output = gray_output1 if 'stream1' in path else gray_output2
+        elif distorted and parse_qs(query).get('mode') != ['plain']:
+            output = distorted_output1 if 'stream1' in path else distorted_output2
+        else:
+            output = output1 if 'stream1' in path else output2
+
+        serve_stream(self, output, 1 if path.endswith('1.mjpg') else 2, cls, query, admission, watchdog, tracer)
+
+    def stream_lens(self):
         self.send_response(200)
-        self.send_header('Age', 0)
         self.send_header('Cache-Control', 'no-cache, private')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+        self.send_header('Content-Type', 'text/event-stream')
         self.end_headers()
 
-        output = output1 if 'stream1' in path else output2
-        apply_distortion = distorted
-
+        with lens_feed.condition:
+            lens_feed.clients += 1
         try:
-            while True:
-                with output.condition:
-                    output.condition.wait()
-                    frame = output.frame
-
-                if apply_distortion:
-                    frame = self.apply_barrel_distortion(frame)
-
-                self.wfile.write(b'--FRAME\r\n')
-                self.send_header('Content-Type', 'image/jpeg')
-                self.send_header('Content-Length', len(frame))
-                self.end_headers()
-                self.wfile.write(frame)
-                self.wfile.write(b'\r\n')
+            with watchdog.watch(self) as watch:
+                version = None
+                while True:
+                    event, version = lens_feed.next(version)
+                    self.wfile.write(event or b': keepalive\n\n')
+                    watch.progress()
         except Exception as e:
-            logging.warning('Streaming client removed: %s', str(e))
-
-    @staticmethod
-    def apply_barrel_distortion(frame):
-        np_arr = np.frombuffer(frame, np.uint8)
-        image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-
-        square_image = crop_to_square(image)
-
-        height, width = square_image.shape[:2]
-        camera_matrix = np.array([[width, 0, width / 2],
-                                   [0, height, height / 2],
-                                   [0, 0, 1]], dtype=np.float32)
-        distortion_coefficients = np.array([0.3, 0.1, 0, 0], dtype=np.float32)
-
-        new_camera_matrix, _ = cv2.getOptimalNewCameraMatrix(camera_matrix, distortion_coefficients, (width, height), 1)
-        map1, map2 = cv2.initUndistortRectifyMap(camera_matrix, distortion_coefficients, None, new_camera_matrix,
-                                                 (width, height), cv2.CV_32FC1)
-        distorted_image = cv2.remap(square_image, map1, map2, cv2.INTER_LINEAR)
-
-        _, encoded_image = cv2.imencode('.jpg', distorted_image)
-        return encoded_image.tobytes()
+            logging.warning('Lens client removed: %s', str(e))
+        finally:
+            with lens_feed.condition:
+                lens_feed.clients -= 1
 
     def do_POST(self):
         if self.path == '/update':
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length).decode('utf-8')
             params = parse_qs(post_data)
-            global left_value, right_value, distorted
+            global left_value, right_value, distorted, client_profile
 
             left_value = int(params.get('left', [left_value])[0])
             right_value = int(params.get('right', [right_value])[0])
             distorted = params.get('distorted', ['false'])[0].lower() == 'true'
+            if frontend is not None:
+                frontend.distorted.value = distorted
+            if 'k1' in params or 'k2' in params or 'rotation' in params:
+                k1 = float(params.get('k1', [client_profile.green[0]])[0])
+                k2 = float(params.get('k2', [client_profile.green[1]])[0])
+                client_profile = LensProfile((k1, k2), (k1, k2), (k1, k2),
+                                             float(params.get('rotation', [client_profile.rotation])[0]),
+                                             client_profile.output_size)
+            lens_feed.publish(lens_settings(client_profile, distorted))
+
+            apply_crop(picam1, left_value - CENTRED_OFFSET, 90)
+            apply_crop(picam2, CENTRED_OFFSET - right_value, 270)
 
             print(f"Updated values: left={left_value}, right={right_value}, distorted={distorted}")
 
             self.send_response(200)
             self.end_headers()
             self.wfile.write(b'Values updated')
+        elif self.path == '/view':
+            content_length = int(self.headers['Content-Length'])
+            params = parse_qs(self.rfile.read(content_length).decode('utf-8'))
+            # One shared view per camera (see roi.py): the last post wins.
+            try:
+                x = float(params.get('x', ['0.5'])[0])
+                y = float(params.get('y', ['0.5'])[0])
+                view1.update(x, y)
+                view2.update(x, y)
+            except ValueError:
+                self.send_error(400, 'x and y must be numbers')
+                return
+
+            content = json.dumps({
+                'stream1': display_rect(roi_rect(MAIN_SIZE, view1.get(), ROI_SIZE), MAIN_SIZE, view1.rotation),
+                'stream2': display_rect(roi_rect(MAIN_SIZE, view2.get(), ROI_SIZE), MAIN_SIZE, view2.rotation),
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
         else:
             self.send_error(404)
             self.end_headers()
@@ -198,37 +575,129 @@ class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     daemon_threads = True
 
 
-picam1 = Picamera2(0)
-picam1.configure(picam1.create_video_configuration(
-    buffer_count=3,
-    main={"size": (1640, 1232), "format": "YUV420"},
-    lores={"size": (960, 720)},
-    encode="lores",
-    display="lores",
-    transform=Transform(rotation=90)
-))
-output1 = StreamingOutput()
-picam1.start_recording(MJPEGEncoder(), FileOutput(output1))
-
-picam2 = Picamera2(1)
-picam2.configure(picam2.create_video_configuration(
-    buffer_count=3,
-    main={"size": (1640, 1232), "format": "YUV420"},
-    lores={"size": (960, 720)},
-    encode="lores",
-    display="lores",
-    transform=Transform(rotation=270)
-))
-output2 = StreamingOutput()
-picam2.start_recording(MJPEGEncoder(), FileOutput(output2))
-
+view1 = ViewTracker(90)
+view2 = ViewTracker(270)
+
+# Without live camera callbacks the gate would never see motion.
+gated = CHANGE_GATE and not REPLAY_DIR
+# The ROI and HQ streams are cut from main.
+full_main = MAIN_STREAM == 'hq' and not REPLAY_DIR
+output1 = StreamingOutput(ChangeGate(keepalive_fps=KEEPALIVE_FPS) if gated else None)
+output2 = StreamingOutput(ChangeGate(keepalive_fps=KEEPALIVE_FPS) if gated else None)
+output1.frame_clock = True
+roi_output1 = StreamingOutput()
+roi_output2 = StreamingOutput()
+roi1 = RoiStream(roi_output1, view1, MAIN_SIZE, ROI_SIZE)
+roi2 = RoiStream(roi_output2, view2, MAIN_SIZE, ROI_SIZE)
+distorted_output1 = StreamingOutput()
+distorted_output2 = StreamingOutput()
+gray_output1 = StreamingOutput()
+gray_output2 = StreamingOutput()
+gray1 = GrayStream(gray_output1, LORES_SIZE)
+gray2 = GrayStream(gray_output2, LORES_SIZE)
+depth_output = StreamingOutput()
+hq_output1 = StreamingOutput()
+hq_output2 = StreamingOutput()
+jpeg_outputs = {
+    'stream1': output1, 'stream2': output2,
+    'distorted_stream1': distorted_output1, 'distorted_stream2': distorted_output2,
+    'roi1': roi_output1, 'roi2': roi_output2,
+    'gray_stream1': gray_output1, 'gray_stream2': gray_output2,
+    'depth': depth_output,
+    'hq1': hq_output1, 'hq2': hq_output2,
+}
+for name, output in jpeg_outputs.items():
+    output.name = name
+if FRAME_BUS:
+    for name, output in jpeg_outputs.items():
+        output.bus = FrameBus(f'mandro_{name}_jpeg', FRAME_BUS_JPEG_SIZE, FRAME_BUS_SLOTS)
+lores_bus1 = lores_bus2 = None
+depth = depth_bus = None
+hq1 = hq2 = None
+if DEPTH and not REPLAY_DIR:
+    if FRAME_BUS:
+        depth_bus = FrameBus('mandro_depth_disparity', LORES_SIZE[0] * LORES_SIZE[1] * 2, FRAME_BUS_SLOTS)
+    depth = DepthStream(depth_output, depth_bus, LORES_SIZE, (90, 270),
+                        StereoCalibration.load(STEREO_CALIBRATION) if STEREO_CALIBRATION else None)
+controller = None
+if RECORD_DIR:
+    output1.recorder = Recorder(os.path.join(RECORD_DIR, 'stream1'))
+    output2.recorder = Recorder(os.path.join(RECORD_DIR, 'stream2'))
+
+if REPLAY_DIR:
+    picam1 = ReplayCamera(os.path.join(REPLAY_DIR, 'stream1'), REPLAY_SPEED)
+    picam1.start_recording(None, output1)
+    picam2 = ReplayCamera(os.path.join(REPLAY_DIR, 'stream2'), REPLAY_SPEED)
+    picam2.start_recording(None, output2)
+else:
+    main = main_config(MAIN_STREAM, LORES_SIZE, MAIN_SIZE)
+    picam1 = Picamera2(0)
+    picam1.configure(picam1.create_video_configuration(
+        buffer_count=3,
+        main=main,
+        lores={"size": LORES_SIZE},
+        encode="lores",
+        display="lores",
+        transform=Transform(rotation=90),
+        **sensor_mode.select(picam1, main['size'], PROFILES[ENCODER_PROFILES['stream1']].fps, name='stream1')
+    ))
+    apply_crop(picam1, left_value - CENTRED_OFFSET, 90)
+    lores_bus1 = lores_bus(picam1, 'mandro_stream1_lores')
+    picam1.pre_callback = lores_callback(output1, lores_bus1, gray1, 0)
+    if full_main:
+        picam1.post_callback = roi1.callback
+    file_output1 = SensorTimedOutput(output1)
+    encoder1 = file_output1.encoder = start_encoder(picam1, PROFILES[ENCODER_PROFILES['stream1']], file_output1)
+
+    picam2 = Picamera2(1)
+    picam2.configure(picam2.create_video_configuration(
+        buffer_count=3,
+        main=main,
+        lores={"size": LORES_SIZE},
+        encode="lores",
+        display="lores",
+        transform=Transform(rotation=270),
+        **sensor_mode.select(picam2, main['size'], PROFILES[ENCODER_PROFILES['stream2']].fps, name='stream2')
+    ))
+    apply_crop(picam2, CENTRED_OFFSET - right_value, 270)
+    lores_bus2 = lores_bus(picam2, 'mandro_stream2_lores')
+    picam2.pre_callback = lores_callback(output2, lores_bus2, gray2, 1)
+    if full_main:
+        picam2.post_callback = roi2.callback
+    file_output2 = SensorTimedOutput(output2)
+    encoder2 = file_output2.encoder = start_encoder(picam2, PROFILES[ENCODER_PROFILES['stream2']], file_output2)
+
+    if full_main:
+        hq1 = HqStream(picam1, hq_output1, PROFILES[ENCODER_PROFILES['stream1']].fps, HQ_FPS)
+        hq2 = HqStream(picam2, hq_output2, PROFILES[ENCODER_PROFILES['stream2']].fps, HQ_FPS)
+
+    if UPLINK_CAPACITY:
+        controller = BitrateController(
+            [Camera('stream1', picam1, encoder1, output1), Camera('stream2', picam2, encoder2, output2)],
+            UPLINK_CAPACITY, [distorted_output1, distorted_output2, roi_output1, roi_output2,
+                              gray_output1, gray_output2, depth_output, hq_output1, hq_output2])
+
+Thread(target=distort_stream, args=('stream1', output1, distorted_output1), daemon=True).start()
+Thread(target=distort_stream, args=('stream2', output2, distorted_output2), daemon=True).start()
 
 try:
-    address = ('', 8000)
+    address = CONTROL_ADDRESS if frontend is not None else ('', 8000)
     server = StreamingServer(address, StreamingHandler)
     server.serve_forever()
 finally:
     picam1.stop_recording()
     picam2.stop_recording()
+    if pool is not None:
+        pool.close()
+    if frontend is not None:
+        frontend.close()
+    for output in jpeg_outputs.values():
+        if output.recorder is not None:
+            output.recorder.close()
+        if output.bus is not None:
+            output.bus.close()
+    for bus in (lores_bus1, lores_bus2, depth_bus):
+        if bus is not None:
+            bus.close()
 
 
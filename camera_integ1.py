@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import io
+import json
 import logging
 import socketserver
 import cv2
@@ -10,12 +11,17 @@ from http import server
 from threading import Condition
 from urllib.parse import parse_qs
 
-from picamera2 import Picamera2
+from picamera2 import MappedArray, Picamera2
 from picamera2.encoders import MJPEGEncoder
 from picamera2.outputs import FileOutput
 
 from libcamera import Transform
 
+from change_gate import ChangeGate
+from jpeg_encoder import encoder
+from main_stream import main_config, memory_stats
+from stream_watchdog import SEND_TIMEOUT, Watchdog
+
 PAGE_TEMPLATE = """\
 <html>
 <head>
@@ -76,6 +82,19 @@ PAGE_TEMPLATE = """\
 left_value = -17
 right_value = -17
 
+# Streaming clients that get no frame for this long are disconnected.
+STALL_SECONDS = 30
+# main is never read here; 'low' shrinks it to the lores size so its
+# buffers don't take CMA memory (see main_stream.py).
+MAIN_STREAM = 'low'
+# picamera2's default for video configurations.
+CAMERA_FPS = 30
+CHANGE_GATE = True
+KEEPALIVE_FPS = 1.0
+LORES_SIZE = (960, 720)
+
+watchdog = Watchdog(STALL_SECONDS)
+
 def crop_to_square(image):
     height, width = image.shape[:2]
     size = min(width, height)
@@ -86,17 +105,29 @@ def crop_to_square(image):
 
 
 class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
+    def __init__(self, gate=None):
         self.frame = None
         self.condition = Condition()
+        self.gate = gate
 
     def write(self, buf):
+        if self.gate is not None and not self.gate.admit():
+            return
         with self.condition:
             self.frame = buf
             self.condition.notify_all()
 
 
+def watch_scene(output):
+    def callback(request):
+        with MappedArray(request, 'lores') as m:
+            output.gate.observe(m.array[:LORES_SIZE[1]])
+    return callback
+
+
 class StreamingHandler(server.BaseHTTPRequestHandler):
+    timeout = SEND_TIMEOUT
+
     def do_GET(self):
         if self.path == '/':
             content = PAGE_TEMPLATE.format(left_value=left_value, right_value=right_value).encode('utf-8')
@@ -130,6 +161,17 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
         elif self.path in ['/normal_stream1.mjpg', '/normal_stream2.mjpg',
                            '/distorted_stream1.mjpg', '/distorted_stream2.mjpg']:
             self.stream_video(self.path)
+        elif self.path == '/stats':
+            content = json.dumps({
+                'handlers': watchdog.stats(),
+                'gates': {'stream1': output1.gate and output1.gate.stats(), 'stream2': output2.gate and output2.gate.stats()},
+                'memory': {'stream1': memory_stats(picam1, CAMERA_FPS), 'stream2': memory_stats(picam2, CAMERA_FPS)},
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
         else:
             self.send_error(404)
             self.end_headers()
@@ -152,20 +194,22 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             apply_distortion = True
 
         try:
-            while True:
-                with output.condition:
-                    output.condition.wait()
-                    frame = output.frame
-
-                if apply_distortion:
-                    frame = self.apply_barrel_distortion(frame)
-
-                self.wfile.write(b'--FRAME\r\n')
-                self.send_header('Content-Type', 'image/jpeg')
-                self.send_header('Content-Length', len(frame))
-                self.end_headers()
-                self.wfile.write(frame)
-                self.wfile.write(b'\r\n')
+            with watchdog.watch(self) as watch:
+                while True:
+                    with output.condition:
+                        watch.wait(output.condition)
+                        frame = output.frame
+
+                    if apply_distortion:
+                        frame = self.apply_barrel_distortion(frame)
+
+                    self.wfile.write(b'--FRAME\r\n')
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', len(frame))
+                    self.end_headers()
+                    self.wfile.write(frame)
+                    self.wfile.write(b'\r\n')
+                    watch.progress()
         except Exception as e:
             logging.warning('Streaming client removed: %s', str(e))
 
@@ -187,8 +231,7 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
                                                  (width, height), cv2.CV_32FC1)
         distorted_image = cv2.remap(square_image, map1, map2, cv2.INTER_LINEAR)
 
-        _, encoded_image = cv2.imencode('.jpg', distorted_image)
-        return encoded_image.tobytes()
+        return encoder('distorted').encode(distorted_image)
 
     def do_POST(self):
         if self.path == '/update':
@@ -214,25 +257,29 @@ class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
 picam1 = Picamera2(0)
 picam1.configure(picam1.create_video_configuration(
     buffer_count=3,
-    main={"size": (1640, 1232), "format": "YUV420"},
-    lores={"size": (960, 720)},
+    main=main_config(MAIN_STREAM, LORES_SIZE),
+    lores={"size": LORES_SIZE},
     encode="lores",
     display="lores",
     transform=Transform(rotation=90)
 ))
-output1 = StreamingOutput()
+output1 = StreamingOutput(ChangeGate(keepalive_fps=KEEPALIVE_FPS) if CHANGE_GATE else None)
+if output1.gate is not None:
+    picam1.pre_callback = watch_scene(output1)
 picam1.start_recording(MJPEGEncoder(), FileOutput(output1))
 
 picam2 = Picamera2(1)
 picam2.configure(picam2.create_video_configuration(
     buffer_count=3,
-    main={"size": (1640, 1232), "format": "YUV420"},
-    lores={"size": (960, 720)},
+    main=main_config(MAIN_STREAM, LORES_SIZE),
+    lores={"size": LORES_SIZE},
     encode="lores",
     display="lores",
     transform=Transform(rotation=270)
 ))
-output2 = StreamingOutput()
+output2 = StreamingOutput(ChangeGate(keepalive_fps=KEEPALIVE_FPS) if CHANGE_GATE else None)
+if output2.gate is not None:
+    picam2.pre_callback = watch_scene(output2)
 picam2.start_recording(MJPEGEncoder(), FileOutput(output2))
 
 
@@ -0,0 +1,78 @@
+# Drops a stream to a keep-alive rate while the scene is static.
+#
+# The detector works on a tiny luma image (the Y plane, or one colour
+# channel, averaged over step x step blocks), so it is cheap enough to run
+# on every frame, and the averaging evens out sensor noise. As soon as at
+# least min_fraction of the blocks differ from the last reference by more
+# than pixel_threshold, the stream goes back to full rate. A mean over the
+# whole frame would miss a small object moving: 5% of the frame changing by
+# 50 only moves it by 2.5.
+#
+# What an idle stream saves depends on where the gate sits. The UDP senders
+# and the software encoders (distortion, gray, ROI) skip the encode itself.
+# The MJPEG servers gate the hardware encoder's output, and that encoder
+# runs on every frame regardless, so there the saving is the network, the
+# clients, and the per-frame software work downstream (camera_distortion
+# and camera_integ1 decode, warp and re-encode every frame they pass on).
+
+import time
+from threading import Lock
+
+import cv2
+import numpy as np
+
+
+class ChangeGate:
+    def __init__(self, pixel_threshold=25, min_fraction=0.005, keepalive_fps=1.0, hold_seconds=1.0, step=16):
+        self.pixel_threshold = pixel_threshold
+        self.min_fraction = min_fraction
+        self.keepalive_interval = 1.0 / keepalive_fps if keepalive_fps > 0 else None
+        self.hold_seconds = hold_seconds
+        self.step = step
+        self.reference = None
+        self.last_change = 0.0
+        self.last_sent = 0.0
+        self.sent = 0
+        self.suppressed = 0
+        self.changed = 0.0
+        self.lock = Lock()
+
+    def observe(self, luma):
+        height, width = luma.shape[:2]
+        size = (max(1, width // self.step), max(1, height // self.step))
+        small = cv2.resize(luma, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+        with self.lock:
+            if self.reference is None or self.reference.shape != small.shape:
+                self.reference = small
+                self.last_change = time.monotonic()
+                return True
+            self.changed = float(np.count_nonzero(np.abs(small - self.reference) > self.pixel_threshold)) / small.size
+            if self.changed >= self.min_fraction:
+                self.reference = small
+                self.last_change = time.monotonic()
+                return True
+            return False
+
+    def observe_rgb(self, frame):
+        # The green channel is a good enough stand-in for luma here.
+        return self.observe(frame[:, :, 1])
+
+    def admit(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = now - self.last_change >= self.hold_seconds
+            if idle and (self.keepalive_interval is None or now - self.last_sent < self.keepalive_interval):
+                self.suppressed += 1
+                return False
+            self.last_sent = now
+            self.sent += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'idle': time.monotonic() - self.last_change >= self.hold_seconds,
+                'sent': self.sent,
+                'suppressed': self.suppressed,
+                'changed': round(self.changed, 4),
+            }
@@ -0,0 +1,226 @@
+# Disparity from the two cameras' lores frames.
+#
+# The camera callbacks only copy the Y plane into a free buffer, with the
+# sensor timestamp; frames from the two cameras are paired when they were
+# captured within tolerance seconds of each other. Matching happens on a
+# separate thread, newest pair first, so the cameras are never held up:
+#
+#   - one remap per camera through tables built once per frame size. They
+#     fold in the page's 90/270 degree rotation, so the pair comes out
+#     upright, and the stereo rectification when a calibration is given;
+#   - pyramid_levels halvings with pyrDown;
+#   - StereoBM on the rectified region only, cut into horizontal bands with
+#     a block's worth of overlap, one band per thread; OpenCV releases the
+#     GIL, so the bands run on separate cores.
+#
+# Disparities are StereoBM's: int16 in 1/16 pixel at the reduced size, with
+# negative values where there was no match.
+#
+# Calibration is a JSON file with cv2.stereoCalibrate's K1, D1, K2, D2, R
+# and T for the upright images, and the size they were taken at. Without
+# one the rig is assumed rectified already.
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Thread
+
+import cv2
+import numpy as np
+
+from buffers import ArrayPool
+from jpeg_encoder import encoder
+from roi import to_source
+
+PYRAMID_LEVELS = 1
+NUM_DISPARITIES = 32
+BLOCK_SIZE = 15
+BANDS = 3
+
+
+class StereoCalibration:
+    def __init__(self, K1, D1, K2, D2, R, T, size):
+        self.K1 = np.array(K1, dtype=np.float64)
+        self.D1 = np.array(D1, dtype=np.float64)
+        self.K2 = np.array(K2, dtype=np.float64)
+        self.D2 = np.array(D2, dtype=np.float64)
+        self.R = np.array(R, dtype=np.float64)
+        self.T = np.array(T, dtype=np.float64).reshape(3, 1)
+        self.size = tuple(size)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def rectify(self, size):
+        # Per-camera (R, P) for upright frames of size, and the region valid
+        # in both rectified frames. Focal lengths scale with the frame.
+        scale = np.diag([size[0] / self.size[0], size[1] / self.size[1], 1])
+        K1, K2 = scale @ self.K1, scale @ self.K2
+        R1, R2, P1, P2, _, roi1, roi2 = cv2.stereoRectify(
+            K1, self.D1, K2, self.D2, size, self.R, self.T, alpha=0)
+        return [(K1, self.D1, R1, P1), (K2, self.D2, R2, P2)], intersect(roi1, roi2)
+
+
+def intersect(a, b):
+    x, y = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    return (x, y, max(right - x, 0), max(bottom - y, 0))
+
+
+def build_maps(calibration, frame_size, rotations):
+    # frame_size is the lores size as captured; the upright frames are
+    # transposed by the page's quarter turn.
+    width, height = frame_size
+    upright = (height, width) if rotations[0] % 180 else (width, height)
+    if calibration is not None:
+        cameras, valid = calibration.rectify(upright)
+    else:
+        cameras, valid = [None, None], (0, 0) + upright
+
+    maps = []
+    for camera, rotation in zip(cameras, rotations):
+        if camera is None:
+            u, v = np.meshgrid(np.arange(upright[0], dtype=np.float32), np.arange(upright[1], dtype=np.float32))
+        else:
+            u, v = cv2.initUndistortRectifyMap(*camera, upright, cv2.CV_32FC1)
+        # From upright pixel centres back into the frame as captured.
+        x, y = to_source((u + 0.5) / upright[0], (v + 0.5) / upright[1], rotation)
+        maps.append(cv2.convertMaps(x * width - 0.5, y * height - 0.5, cv2.CV_16SC2))
+    return maps, valid
+
+
+class DepthStream:
+    def __init__(self, output, bus=None, frame_size=(400, 400), rotations=(90, 270),
+                 calibration=None, tolerance=0.015, max_fps=15.0, pyramid_levels=PYRAMID_LEVELS,
+                 num_disparities=NUM_DISPARITIES, block_size=BLOCK_SIZE, bands=BANDS, buffers=4):
+        self.output = output
+        self.bus = bus
+        self.frame_size = frame_size
+        self.tolerance = tolerance
+        self.interval = 1 / max_fps
+        self.pyramid_levels = pyramid_levels
+        self.num_disparities = num_disparities
+        self.block_size = block_size
+        self.maps, valid = build_maps(calibration, frame_size, rotations)
+        scale = 2 ** pyramid_levels
+        self.valid = tuple(v // scale for v in valid)
+        self.matchers = [cv2.StereoBM_create(num_disparities, block_size) for _ in range(bands)]
+        self.executor = ThreadPoolExecutor(bands)
+        self.pool = ArrayPool()
+
+        width, height = frame_size
+        self.free = [[np.empty((height, width), np.uint8) for _ in range(buffers)] for _ in range(2)]
+        self.latest = [None, None]
+        self.pending = None
+        self.condition = Condition()
+        self.pairs = 0
+        self.frames = 0
+        self.dropped = 0
+        self.unpaired = 0
+        self.match_seconds = 0.0
+        self.last_started = 0.0
+        Thread(target=self.match_loop, daemon=True).start()
+
+    def wanted(self):
+        return self.output.wanted() or self.bus is not None and self.bus.has_readers()
+
+    def submit(self, camera, luma, timestamp_ns):
+        # Called from camera camera's (0 or 1) callback with its Y plane.
+        with self.condition:
+            if not self.free[camera]:
+                self.dropped += 1
+                return
+            buffer = self.free[camera].pop()
+        np.copyto(buffer, luma)
+
+        with self.condition:
+            if self.latest[camera] is not None:
+                self.free[camera].append(self.latest[camera][0])
+                self.unpaired += 1
+            self.latest[camera] = (buffer, timestamp_ns)
+            other = self.latest[1 - camera]
+            if other is None or abs(timestamp_ns - other[1]) > self.tolerance * 1e9:
+                return
+            if self.pending is not None:
+                for index, (old, _) in enumerate(self.pending):
+                    self.free[index].append(old)
+                self.dropped += 1
+            self.pending = tuple(self.latest)
+            self.latest = [None, None]
+            self.pairs += 1
+            self.condition.notify()
+
+    def match_loop(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                pair = self.pending
+                self.pending = None
+            if time.monotonic() - self.last_started < self.interval:
+                with self.condition:
+                    for index, (buffer, _) in enumerate(pair):
+                        self.free[index].append(buffer)
+                continue
+            self.last_started = time.monotonic()
+
+            started = time.perf_counter()
+            disparity = self.match(pair[0][0], pair[1][0])
+            self.match_seconds += time.perf_counter() - started
+            with self.condition:
+                for index, (buffer, _) in enumerate(pair):
+                    self.free[index].append(buffer)
+            self.frames += 1
+            self.publish(disparity)
+
+    def match(self, left, right):
+        images = []
+        for index, (image, (map1, map2)) in enumerate(zip((left, right), self.maps)):
+            rectified = self.pool.get(f'rectified{index}', map1.shape[:2])
+            cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=rectified)
+            for _ in range(self.pyramid_levels):
+                rectified = cv2.pyrDown(rectified)
+            images.append(rectified)
+
+        height, width = images[0].shape
+        disparity = self.pool.get('disparity', (height, width), np.int16)
+        disparity.fill(-16)
+        x, y, roi_width, roi_height = self.valid
+        if roi_width <= self.num_disparities or roi_height < self.block_size:
+            return disparity
+
+        # Bands overlap by half a block so every output row sees a full block.
+        margin = self.block_size // 2
+        bands = len(self.matchers)
+        edges = [y + roi_height * band // bands for band in range(bands + 1)]
+
+        def band(index):
+            top, bottom = edges[index], edges[index + 1]
+            above, below = max(top - margin, y), min(bottom + margin, y + roi_height)
+            window = (slice(above, below), slice(x, x + roi_width))
+            result = self.matchers[index].compute(images[0][window], images[1][window])
+            disparity[top:bottom, x:x + roi_width] = result[top - above:bottom - above]
+
+        list(self.executor.map(band, range(bands)))
+        return disparity
+
+    def publish(self, disparity):
+        if self.bus is not None and self.bus.has_readers():
+            self.bus.publish(disparity, b'DS16')
+        if self.output.wanted():
+            scaled = cv2.convertScaleAbs(disparity, alpha=255 / (self.num_disparities * 16))
+            coloured = cv2.applyColorMap(scaled, cv2.COLORMAP_JET, dst=self.pool.get('coloured', scaled.shape + (3,)))
+            self.output.write(encoder('depth').encode(coloured))
+
+    def stats(self):
+        frames = max(self.frames, 1)
+        return {
+            'pairs': self.pairs,
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'unpaired': self.unpaired,
+            'match_ms': round(self.match_seconds / frames * 1000, 2),
+            'valid': self.valid,
+        }
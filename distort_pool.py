@@ -0,0 +1,140 @@
+# Runs decode -> distort -> encode in worker processes so the distorted
+# streams can use every core instead of serialising on the GIL.
+#
+# Frames travel through multiprocessing.shared_memory slots; the queues only
+# carry slot numbers and sequence numbers. Results are handed back per stream
+# in the order they were submitted.
+
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+from distortion import BarrelDistorter
+
+SLOT_SIZE = 1024 * 1024
+
+
+def run_worker(index, profile, shm, slot_size, tasks, results):
+    distorter = BarrelDistorter(profile)
+    buf = shm.buf
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, stream, seq, length = task
+        started = time.perf_counter()
+        base = slot * 2 * slot_size
+        try:
+            frame = distorter.apply(buf[base:base + length])
+            length = len(frame)
+            if length > slot_size:
+                length = -1
+            else:
+                buf[base + slot_size:base + slot_size + length] = frame
+        except Exception:
+            length = -1
+        results.put((slot, stream, seq, length, index, time.perf_counter() - started))
+
+
+class DistortionPool:
+    def __init__(self, workers=3, profile=None, slots=8, slot_size=SLOT_SIZE):
+        # Fork before the cameras start their threads; spawn would re-run the
+        # server script in every worker.
+        ctx = multiprocessing.get_context('fork')
+        self.slot_size = slot_size
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * 2 * slot_size)
+        self.free = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.tasks = ctx.SimpleQueue()
+        self.results = ctx.SimpleQueue()
+        self.lock = threading.Lock()
+        self.sinks = {}
+        self.next_submit = {}
+        self.next_deliver = {}
+        self.pending = {}
+        self.busy = [0.0] * workers
+        self.done = [0] * workers
+        self.dropped = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.processes = [ctx.Process(target=run_worker, daemon=True,
+                                      args=(index, profile, self.shm, slot_size, self.tasks, self.results))
+                          for index in range(workers)]
+        for process in self.processes:
+            process.start()
+        threading.Thread(target=self.collect, daemon=True).start()
+
+    def submit(self, stream, frame, sink):
+        # Never block the caller: with every slot in flight the frame is
+        # dropped, which keeps latency bounded when the workers fall behind.
+        try:
+            slot = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        length = len(frame)
+        if length > self.slot_size:
+            self.free.put(slot)
+            self.dropped += 1
+            return False
+        base = slot * 2 * self.slot_size
+        self.shm.buf[base:base + length] = frame
+        with self.lock:
+            seq = self.next_submit.get(stream, 0)
+            self.next_submit[stream] = seq + 1
+            self.sinks[stream] = sink
+        self.tasks.put((slot, stream, seq, length))
+        return True
+
+    def collect(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            slot, stream, seq, length, worker, busy = result
+            self.busy[worker] += busy
+            self.done[worker] += 1
+            frame = None
+            if length >= 0:
+                base = slot * 2 * self.slot_size + self.slot_size
+                frame = bytes(self.shm.buf[base:base + length])
+            else:
+                self.failed += 1
+            self.free.put(slot)
+
+            with self.lock:
+                pending = self.pending.setdefault(stream, {})
+                pending[seq] = frame
+                seq = self.next_deliver.get(stream, 0)
+                ready = []
+                while seq in pending:
+                    ready.append(pending.pop(seq))
+                    seq += 1
+                self.next_deliver[stream] = seq
+                sink = self.sinks[stream]
+            for frame in ready:
+                if frame is not None:
+                    sink(frame)
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {
+            'workers': [{'frames': done, 'utilisation': round(busy / elapsed, 3)}
+                        for done, busy in zip(self.done, self.busy)],
+            'in_flight': self.slots - self.free.qsize(),
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=1)
+        self.results.put(None)
+        self.shm.close()
+        self.shm.unlink()
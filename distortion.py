@@ -0,0 +1,133 @@
+# Lens pre-warp for the headset view.
+#
+# Crop to square, rotation, barrel distortion and output scaling are folded
+# into one remap table, built once per frame size, so the warp is a single
+# table-driven pass over the source buffer. Different coefficients per
+# channel correct the lens' chromatic aberration; when all three match the
+# table maps whole BGR pixels.
+#
+# Otherwise the table has one entry per output byte: column 3 * u + c of the
+# output, viewed as one (height, 3 * width) channel, samples channel c at
+# that channel's position. Bilinear sampling reads the next column, which in
+# the interleaved source is another channel, so the source is first split
+# into planes stacked as one (3 * height, width) image, plane c at rows
+# c * height. That split is the one extra pass over the frame.
+
+import json
+
+import cv2
+import numpy as np
+
+from buffers import ArrayPool, tracker
+from jpeg_encoder import encoder
+
+DISTORTION_COEFFICIENTS = (0.3, 0.1)
+
+
+class LensProfile:
+    def __init__(self, red=DISTORTION_COEFFICIENTS, green=DISTORTION_COEFFICIENTS,
+                 blue=DISTORTION_COEFFICIENTS, rotation=0, output_size=None):
+        self.red = tuple(red)
+        self.green = tuple(green)
+        self.blue = tuple(blue)
+        self.rotation = rotation
+        self.output_size = tuple(output_size) if output_size else None
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def channels(self):
+        # OpenCV images are BGR.
+        if self.red == self.green == self.blue:
+            return [self.green]
+        return [self.blue, self.green, self.red]
+
+
+def framing(profile, side):
+    # The green channel sets the output framing so the channels stay aligned.
+    camera_matrix = np.array([[side, 0, side / 2],
+                              [0, side, side / 2],
+                              [0, 0, 1]], dtype=np.float32)
+    new_camera_matrix, _ = cv2.getOptimalNewCameraMatrix(
+        camera_matrix, np.array(profile.green + (0, 0), dtype=np.float32), (side, side), 1)
+    return new_camera_matrix
+
+
+def build_maps(profile, width, height):
+    side = min(width, height)
+    x_start = (width - side) // 2
+    y_start = (height - side) // 2
+    out_width, out_height = profile.output_size or (side, side)
+
+    new_camera_matrix = framing(profile, side)
+
+    u, v = np.meshgrid(np.arange(out_width, dtype=np.float32), np.arange(out_height, dtype=np.float32))
+    x = (u + 0.5) * side / out_width - 0.5
+    y = (v + 0.5) * side / out_height - 0.5
+
+    centre = (side - 1) / 2
+    theta = np.deg2rad(profile.rotation)
+    dx, dy = x - centre, y - centre
+    x = np.cos(theta) * dx + np.sin(theta) * dy + centre
+    y = -np.sin(theta) * dx + np.cos(theta) * dy + centre
+
+    x_norm = (x - new_camera_matrix[0, 2]) / new_camera_matrix[0, 0]
+    y_norm = (y - new_camera_matrix[1, 2]) / new_camera_matrix[1, 1]
+    r2 = x_norm * x_norm + y_norm * y_norm
+
+    channels = profile.channels()
+    map_x_all = np.empty((out_height, out_width, len(channels)), dtype=np.float32)
+    map_y_all = np.empty((out_height, out_width, len(channels)), dtype=np.float32)
+    for channel, (k1, k2) in enumerate(channels):
+        factor = 1 + k1 * r2 + k2 * r2 * r2
+        map_x = (side * x_norm * factor + side / 2).astype(np.float32)
+        map_y = (side * y_norm * factor + side / 2).astype(np.float32)
+        # Anything outside the square crop stays black, as if it had been cut.
+        outside = (map_x < 0) | (map_x > side - 1) | (map_y < 0) | (map_y > side - 1)
+        map_x += x_start
+        map_y += y_start + channel * height
+        map_x[outside] = -1
+        map_y[outside] = -1
+        map_x_all[:, :, channel] = map_x
+        map_y_all[:, :, channel] = map_y
+    return cv2.convertMaps(map_x_all.reshape(out_height, -1), map_y_all.reshape(out_height, -1), cv2.CV_16SC2)
+
+
+class BarrelDistorter:
+    def __init__(self, profile=None):
+        self.profile = profile or LensProfile()
+        self.maps = {}
+        self.planar = len(self.profile.channels()) > 1
+        self.pool = ArrayPool()
+
+    def get_maps(self, width, height):
+        maps = self.maps.get((width, height))
+        if maps is None:
+            maps = build_maps(self.profile, width, height)
+            self.maps[(width, height)] = maps
+        return maps
+
+    def distort(self, image):
+        height, width = image.shape[:2]
+        map1, map2 = self.get_maps(width, height)
+        if not self.planar:
+            distorted_image = self.pool.get('distorted', map1.shape[:2] + (3,))
+            cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=distorted_image)
+            return distorted_image
+
+        planes = self.pool.get('planes', (3, height, width))
+        cv2.mixChannels([image], [planes[0], planes[1], planes[2]], [0, 0, 1, 1, 2, 2])
+        out_height, out_width = map1.shape[0], map1.shape[1] // 3
+        distorted_image = self.pool.get('distorted', (out_height, out_width, 3))
+        cv2.remap(planes.reshape(3 * height, width), map1, map2, cv2.INTER_LINEAR,
+                  dst=distorted_image.reshape(out_height, 3 * out_width))
+        return distorted_image
+
+    def apply(self, frame):
+        image = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+        tracker.allocated(image.nbytes)
+        encoded_image = encoder('distorted').encode(self.distort(image))
+        tracker.allocated(encoded_image.nbytes)
+        return encoded_image
@@ -0,0 +1,155 @@
+# Encoder settings that actually reach the hardware MJPEG encoder, and a
+# controller that retunes them while streaming.
+#
+# picam.options["quality"] only applies to still captures; the V4L2 MJPEG
+# encoder takes a bitrate (bits/s) instead, from which it derives the JPEG
+# quality per frame. A profile is a bitrate, or a picamera2 Quality name
+# when bitrate is None, plus a frame rate.
+#
+# BitrateController watches what each camera's encoder produces and what is
+# actually written to viewers, and scales the bitrates so the viewer traffic
+# fits the configured uplink. The new bitrate is set with the same
+# VIDIOC_S_CTRL ioctl picamera2 uses when it starts the encoder, on the
+# running encoder; only if the driver refuses is the encoder restarted, which
+# the HTTP clients don't notice beyond a short gap.
+
+import fcntl
+import logging
+import struct
+import threading
+import time
+
+try:
+    from picamera2.encoders import MJPEGEncoder, Quality
+except ImportError:
+    MJPEGEncoder = None
+
+VIDIOC_S_CTRL = 0xC008561C
+V4L2_CID_MPEG_VIDEO_BITRATE = 0x009909CF
+
+
+class EncoderProfile:
+    def __init__(self, bitrate=None, fps=25.0, quality='MEDIUM'):
+        self.bitrate = bitrate
+        self.fps = fps
+        self.quality = quality
+
+
+PROFILES = {
+    'low': EncoderProfile(bitrate=3_000_000, fps=15.0),
+    'normal': EncoderProfile(bitrate=8_000_000, fps=25.0),
+    'high': EncoderProfile(bitrate=15_000_000, fps=30.0),
+}
+
+
+def start_encoder(picam, profile, output):
+    encoder = MJPEGEncoder(bitrate=profile.bitrate)
+    picam.start_recording(encoder, output, quality=Quality[profile.quality])
+    return encoder
+
+
+def set_bitrate(encoder, bitrate):
+    fcntl.ioctl(encoder.vd, VIDIOC_S_CTRL, struct.pack('Ii', V4L2_CID_MPEG_VIDEO_BITRATE, bitrate))
+
+
+class Camera:
+    # One hardware-encoded stream under the controller's care. output is the
+    # StreamingOutput the encoder writes to; its bytes/sent counters give
+    # what was produced and what went out to viewers.
+    def __init__(self, name, picam, encoder, output):
+        self.name = name
+        self.picam = picam
+        self.encoder = encoder
+        self.output = output
+        # picamera2 fills in the bitrate from the quality when it has none.
+        self.base = encoder.bitrate
+        self.bitrate = encoder.bitrate
+        self.produced = 0.0
+        self.fanout = 0.0
+        self.restarts = 0
+        self.last = (output.bytes, output.sent)
+
+    def measure(self, elapsed):
+        produced, sent = self.output.bytes - self.last[0], self.output.sent - self.last[1]
+        self.last = (self.output.bytes, self.output.sent)
+        self.produced = produced * 8 / elapsed
+        self.fanout = sent / produced if produced else 0.0
+        return sent * 8 / elapsed
+
+    def apply(self, bitrate):
+        try:
+            set_bitrate(self.encoder, bitrate)
+        except OSError as e:
+            logging.warning('%s: bitrate ioctl failed (%s), restarting encoder', self.name, str(e))
+            self.picam.stop_encoder(self.encoder)
+            self.encoder.bitrate = bitrate
+            self.picam.start_encoder(self.encoder, self.encoder.output)
+            self.restarts += 1
+        self.bitrate = bitrate
+
+
+class BitrateController:
+    # capacity: uplink available to viewers in bits/s; headroom leaves room
+    # for bursts and everything else on the link. other_outputs are streams
+    # not made by the hardware encoders (distorted, roi) whose traffic comes
+    # off the budget first.
+    def __init__(self, cameras, capacity, other_outputs=(), headroom=0.8,
+                 min_scale=0.2, interval=2.0):
+        self.cameras = cameras
+        self.capacity = capacity
+        self.other_outputs = other_outputs
+        self.headroom = headroom
+        self.min_scale = min_scale
+        self.interval = interval
+        self.scale = 1.0
+        self.throughput = 0.0
+        self.last_other = sum(o.sent for o in other_outputs)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        last = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            try:
+                self.adjust(now - last)
+            except Exception as e:
+                logging.warning('Bitrate adjustment failed: %s', str(e))
+            last = now
+
+    def adjust(self, elapsed):
+        sent = sum(camera.measure(elapsed) for camera in self.cameras)
+        other = sum(o.sent for o in self.other_outputs)
+        other_rate = (other - self.last_other) * 8 / elapsed
+        self.last_other = other
+        self.throughput = sent + other_rate
+
+        # Viewer traffic is bitrate times fan-out; pick one scale for every
+        # camera's base bitrate so that fits what the other streams leave.
+        demand = sum(camera.base * camera.fanout for camera in self.cameras)
+        budget = self.capacity * self.headroom - other_rate
+        scale = 1.0 if demand == 0 else min(max(budget / demand, self.min_scale), 1.0)
+        # Step up gently, down at once.
+        if scale < self.scale or scale - self.scale < 0.05:
+            self.scale = scale
+        else:
+            self.scale += (scale - self.scale) * 0.5
+
+        for camera in self.cameras:
+            bitrate = int(camera.base * self.scale)
+            if bitrate != camera.bitrate and (self.scale == 1.0 or abs(bitrate - camera.bitrate) > camera.bitrate * 0.1):
+                camera.apply(bitrate)
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'throughput': round(self.throughput),
+            'scale': round(self.scale, 3),
+            'cameras': {camera.name: {
+                'bitrate': camera.bitrate,
+                'base': camera.base,
+                'produced': round(camera.produced),
+                'fanout': round(camera.fanout, 2),
+                'restarts': camera.restarts,
+            } for camera in self.cameras},
+        }
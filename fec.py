@@ -0,0 +1,131 @@
+# Packet-level forward error correction for the UDP video stream.
+#
+# A systematic Reed-Solomon style code over GF(256): the k data chunks are
+# sent as-is, followed by m parity chunks built from a Cauchy matrix. Any k
+# of the k + m chunks are enough to rebuild the frame, so up to m lost
+# chunks per frame are recovered without a retransmission round trip.
+# Chunk arithmetic is done a whole chunk at a time with numpy lookup tables.
+#
+# GF(256) has 256 points for the Cauchy matrix, so a frame can have at most
+# MAX_CHUNKS data and parity chunks together. Larger frames get less parity,
+# or none once the data alone takes every point.
+
+import numpy as np
+
+MAX_CHUNKS = 256
+
+EXP = np.zeros(512, dtype=np.uint8)
+LOG = np.zeros(256, dtype=np.int32)
+value = 1
+for power in range(255):
+    EXP[power] = value
+    LOG[value] = power
+    value <<= 1
+    if value & 0x100:
+        value ^= 0x11d
+EXP[255:510] = EXP[:255]
+
+_a, _b = np.meshgrid(np.arange(256), np.arange(256), indexing='ij')
+MUL = np.where((_a == 0) | (_b == 0), 0, EXP[(LOG[_a] + LOG[_b]) % 255]).astype(np.uint8)
+del _a, _b
+
+
+def inverse(a):
+    return int(EXP[255 - LOG[a]])
+
+
+def cauchy(row, column, k):
+    # Rows use points k..k+m-1 and columns 0..k-1, so x + y is never zero
+    # and every square submatrix is invertible.
+    return inverse((k + row) ^ column)
+
+
+def max_parity(k):
+    return max(0, MAX_CHUNKS - k)
+
+
+def encode(chunks, parity):
+    # chunks: (k, chunk_size) uint8 array. Returns (parity, chunk_size).
+    k = len(chunks)
+    if parity > max_parity(k):
+        raise ValueError(f'{k} data chunks leave room for {max_parity(k)} parity chunks, not {parity}')
+    out = np.zeros((parity, chunks.shape[1]), dtype=np.uint8)
+    for row in range(parity):
+        for column in range(k):
+            out[row] ^= MUL[cauchy(row, column, k)][chunks[column]]
+    return out
+
+
+def decode(k, received, chunk_size):
+    # received: {index: chunk} with data chunks at 0..k-1 and parity chunks
+    # at k.. ; a short last data chunk is zero padded. Returns the k data
+    # chunks, or None with fewer than k chunks.
+    if len(received) < k:
+        return None
+    data = np.zeros((k, chunk_size), dtype=np.uint8)
+    missing = []
+    for index in range(k):
+        if index in received:
+            chunk = np.frombuffer(received[index], dtype=np.uint8)
+            data[index, :len(chunk)] = chunk
+        else:
+            missing.append(index)
+    if not missing:
+        return data
+
+    rows = [index - k for index in sorted(received) if index >= k][:len(missing)]
+    size = len(missing)
+    matrix = np.zeros((size, size), dtype=np.uint8)
+    rhs = np.zeros((size, chunk_size), dtype=np.uint8)
+    for i, row in enumerate(rows):
+        rhs[i] = np.frombuffer(received[k + row], dtype=np.uint8)
+        for column in range(k):
+            if column in received:
+                rhs[i] ^= MUL[cauchy(row, column, k)][data[column]]
+        for j, column in enumerate(missing):
+            matrix[i, j] = cauchy(row, column, k)
+
+    # Gauss-Jordan elimination over GF(256), carrying the chunks along.
+    for col in range(size):
+        pivot = next(r for r in range(col, size) if matrix[r, col])
+        if pivot != col:
+            matrix[[col, pivot]] = matrix[[pivot, col]]
+            rhs[[col, pivot]] = rhs[[pivot, col]]
+        scale = inverse(int(matrix[col, col]))
+        matrix[col] = MUL[scale][matrix[col]]
+        rhs[col] = MUL[scale][rhs[col]]
+        for r in range(size):
+            factor = int(matrix[r, col])
+            if r != col and factor:
+                matrix[r] ^= MUL[factor][matrix[col]]
+                rhs[r] ^= MUL[factor][rhs[col]]
+
+    for j, column in enumerate(missing):
+        data[column] = rhs[j]
+    return data
+
+
+class FecController:
+    # Picks the parity overhead from the loss rate the receiver reports.
+    def __init__(self, min_overhead=0.1, max_overhead=0.5):
+        self.min_overhead = min_overhead
+        self.max_overhead = max_overhead
+        self.loss = 0.0
+        self.frames = 0
+        self.capped = 0
+        self.unprotected = 0
+
+    def parity_for(self, k):
+        overhead = min(max(self.min_overhead, 2 * self.loss + self.min_overhead), self.max_overhead)
+        parity = max(1, int(np.ceil(k * overhead)))
+        self.frames += 1
+        if parity > max_parity(k):
+            parity = max_parity(k)
+            self.capped += 1
+            if not parity:
+                self.unprotected += 1
+        return parity
+
+    def stats(self):
+        return {'loss': round(self.loss, 4), 'frames': self.frames, 'capped': self.capped,
+                'unprotected': self.unprotected}
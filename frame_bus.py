@@ -0,0 +1,178 @@
+# Publishes the latest frames to other processes on the robot through POSIX
+# shared memory, so local consumers don't need an HTTP stream, a multipart
+# parser and a JPEG decode each.
+#
+# A bus is one shared memory segment holding a ring of slots. Each slot
+# starts with a 64 byte header followed by the frame:
+#
+#   generation  Q   seqlock: odd while the slot is being written
+#   seq         Q   frame sequence number
+#   timestamp   Q   publish time, time.monotonic_ns() // 1000
+#   length      I   frame length in bytes
+#   rows        H   shape of raw frames as published (an I420 frame has
+#   columns     H   height * 3 / 2 rows); 0 for JPEG
+#   format      4s  b'JPEG', b'I420', b'DS16', ...
+#
+# Readers get a memoryview straight into the slot. The writer only returns
+# to a slot after slots - 1 newer frames, and valid() tells whether it has.
+# Readers touch() the bus while they want frames, so the writer can skip
+# producing frames nobody is reading (has_readers()).
+
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+MAGIC = b'MRFB'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQ')
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct('<QQQIHH4s')
+SLOT_HEADER_SIZE = 64
+LATEST_OFFSET = 16
+READ_AT_OFFSET = 24
+# Element type of raw formats that aren't bytes; DS16 is depth.py's
+# disparity.
+DTYPES = {b'DS16': np.int16}
+
+
+class FrameBus:
+    def __init__(self, name, slot_size, slots=4):
+        self.name = name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = SLOT_HEADER_SIZE + (slot_size + 63) // 64 * 64
+        size = HEADER_SIZE + slots * self.stride
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a server that didn't shut down cleanly.
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.data = np.ndarray((size,), dtype=np.uint8, buffer=self.shm.buf)
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, VERSION, slots, slot_size, 0)
+        self.seq = 0
+        self.oversize = 0
+
+    def publish(self, frame, fmt=b'JPEG', timestamp_us=None):
+        if timestamp_us is None:
+            timestamp_us = time.monotonic_ns() // 1000
+        rows = columns = 0
+        if isinstance(frame, np.ndarray):
+            rows, columns = frame.shape[:2]
+            flat = frame.reshape(-1).view(np.uint8)
+        else:
+            flat = np.frombuffer(frame, dtype=np.uint8)
+        if len(flat) > self.slot_size:
+            self.oversize += 1
+            return
+        seq = self.seq + 1
+        base = HEADER_SIZE + (seq % self.slots) * self.stride
+        buf = self.shm.buf
+        generation = struct.unpack_from('<Q', buf, base)[0]
+        struct.pack_into('<Q', buf, base, generation + 1)
+        self.data[base + SLOT_HEADER_SIZE:base + SLOT_HEADER_SIZE + len(flat)] = flat
+        SLOT_HEADER.pack_into(buf, base, generation + 2, seq, timestamp_us, len(flat), rows, columns, fmt)
+        struct.pack_into('<Q', buf, LATEST_OFFSET, seq)
+        self.seq = seq
+
+    def has_readers(self, within=2.0):
+        read_at = struct.unpack_from('<Q', self.shm.buf, READ_AT_OFFSET)[0]
+        return read_at and time.monotonic_ns() // 1000 - read_at < within * 1e6
+
+    def stats(self):
+        return {'published': self.seq, 'oversize': self.oversize, 'readers': bool(self.has_readers())}
+
+    def close(self):
+        self.data = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class Frame:
+    def __init__(self, seq, timestamp_us, data, rows, columns, fmt, base, generation):
+        self.seq = seq
+        self.timestamp_us = timestamp_us
+        self.data = data
+        self.rows = rows
+        self.columns = columns
+        self.format = fmt
+        self.base = base
+        self.generation = generation
+
+    def array(self):
+        # Raw frames as a (rows, columns) array over the slot, no copy.
+        return np.frombuffer(self.data, dtype=DTYPES.get(self.format, np.uint8)).reshape(self.rows, self.columns)
+
+
+class FrameBusReader:
+    # Usage:
+    #   bus = FrameBusReader('mandro_stream1_lores')
+    #   for frame in bus.frames():
+    #       luma = frame.array()[:400]
+    #       ...
+    #       if not bus.valid(frame): the slot was reused meanwhile
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name)
+        # Readers must not unlink the segment when they exit (Python < 3.13
+        # tracks attached segments as if this process had created them).
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+        magic, version, self.slots, self.slot_size, _ = HEADER.unpack_from(self.shm.buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{name} is not a frame bus')
+        self.stride = SLOT_HEADER_SIZE + (self.slot_size + 63) // 64 * 64
+
+    def latest_seq(self):
+        return struct.unpack_from('<Q', self.shm.buf, LATEST_OFFSET)[0]
+
+    def touch(self):
+        struct.pack_into('<Q', self.shm.buf, READ_AT_OFFSET, time.monotonic_ns() // 1000)
+
+    def read(self, seq=None):
+        if seq is None:
+            seq = self.latest_seq()
+        base = HEADER_SIZE + (seq % self.slots) * self.stride
+        generation, slot_seq, timestamp_us, length, rows, columns, fmt = SLOT_HEADER.unpack_from(self.shm.buf, base)
+        if seq == 0 or generation & 1 or slot_seq != seq:
+            return None
+        data = self.shm.buf[base + SLOT_HEADER_SIZE:base + SLOT_HEADER_SIZE + length]
+        return Frame(seq, timestamp_us, data, rows, columns, fmt, base, generation)
+
+    def valid(self, frame):
+        return struct.unpack_from('<Q', self.shm.buf, frame.base)[0] == frame.generation
+
+    def copy(self, frame):
+        # Copy out of the slot; None if the writer got there first.
+        data = bytes(frame.data)
+        return data if self.valid(frame) else None
+
+    def wait(self, after_seq, timeout=1.0, poll=0.002):
+        deadline = time.monotonic() + timeout
+        while True:
+            seq = self.latest_seq()
+            if seq > after_seq:
+                return seq
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(poll)
+
+    def frames(self, timeout=1.0):
+        # Always the newest frame; frames published while the consumer was
+        # busy are skipped rather than queued.
+        # Touches the bus as it goes: writers only publish while read.
+        seq = self.latest_seq() - 1
+        while True:
+            self.touch()
+            latest = self.wait(seq, timeout)
+            if latest is None:
+                continue
+            seq = latest
+            frame = self.read(seq)
+            if frame is not None:
+                yield frame
+
+    def close(self):
+        self.shm.close()
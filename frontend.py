@@ -0,0 +1,271 @@
+# Serves the MJPEG streams from several worker processes that share the
+# listening port through SO_REUSEPORT, so the kernel spreads viewers across
+# cores and per-viewer writes never compete with capture and distortion for
+# the capture process's GIL.
+#
+# The capture process publishes frames to the frame bus (frame_bus.py). In
+# each worker one pump thread per stream copies new frames out of shared
+# memory, only while that stream has viewers, and the handler threads wait
+# on it the same way they wait on a StreamingOutput in the capture process.
+# A slow viewer only ever blocks its own thread. Requests a worker can't
+# answer itself (control posts, /stats, ...) are forwarded to the capture
+# process's server on control_address.
+
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import socketserver
+import time
+from http import server
+from threading import Condition, Lock, Thread
+from urllib.parse import parse_qs
+
+from admission import Admission, SharedCounts
+from frame_bus import FrameBusReader
+from mjpeg_stream import serve_stream
+from stream_watchdog import SEND_TIMEOUT, Watchdog
+
+# Pumps sleep through most of the interval they've seen between frames,
+# then poll the bus this often until the next one is there.
+POLL_SECONDS = 0.005
+SLEEP_FRACTION = 0.75
+
+
+class BusOutput:
+    def __init__(self, name):
+        self.name = name
+        self.frame = None
+        self.timestamp = None
+        self.condition = Condition()
+        self.frame_id = None
+        self.clients = 0
+        self.frames = 0
+        self.sent = 0
+        Thread(target=self.pump, daemon=True).start()
+
+    def pump(self):
+        reader = None
+        seq = 0
+        interval = None
+        last = None
+        while True:
+            if self.clients == 0:
+                time.sleep(0.1)
+                continue
+            if reader is None:
+                try:
+                    reader = FrameBusReader(self.name)
+                except FileNotFoundError:
+                    time.sleep(1)
+                    continue
+                seq = reader.latest_seq() - 1
+            reader.touch()
+            if interval is not None:
+                time.sleep(max(0.0, last + interval * SLEEP_FRACTION - time.monotonic()))
+            latest = reader.wait(seq, 0.5, POLL_SECONDS)
+            if latest is None:
+                interval = None
+                continue
+            arrived = time.monotonic()
+            if last is not None:
+                delta = min(arrived - last, 1.0)
+                interval = delta if interval is None else 0.9 * interval + 0.1 * delta
+            last = arrived
+            seq = latest
+            frame = reader.read(seq)
+            if frame is None:
+                continue
+            # One copy per frame per worker, so viewers can take as long as
+            # they like to send it without the writer reusing the slot.
+            data = reader.copy(frame)
+            timestamp = frame.timestamp_us / 1e6
+            del frame
+            if data is None:
+                continue
+            with self.condition:
+                self.frame = data
+                self.frame_id = seq
+                self.timestamp = timestamp
+                self.frames += 1
+                self.condition.notify_all()
+
+    def stats(self):
+        return {'frames': self.frames, 'clients': self.clients}
+
+
+class FrontEndHandler(server.BaseHTTPRequestHandler):
+    timeout = SEND_TIMEOUT
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path in worker.pages:
+            content = worker.pages[path].encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif path.endswith('.mjpg'):
+            cls, path = worker.admission.classify(path, query)
+            self.stream_video(path, cls, query)
+        elif path == '/frontend_stats':
+            content = json.dumps(worker.stats()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.forward()
+
+    def do_POST(self):
+        self.forward()
+
+    def stream_video(self, path, cls, query):
+        output = worker.output(path, query)
+        if output is None:
+            self.send_error(404)
+            return
+        serve_stream(self, output, 1 if '1.mjpg' in path else 2, cls, query, worker.admission, worker.watchdog)
+
+    def forward(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        headers = {}
+        if self.headers.get('Content-Type'):
+            headers['Content-Type'] = self.headers['Content-Type']
+        try:
+            connection = http.client.HTTPConnection(*worker.control_address, timeout=SEND_TIMEOUT)
+            connection.request(self.command, self.path, body, headers)
+            response = connection.getresponse()
+            if response.getheader('Content-Type') == 'text/event-stream':
+                self.relay(connection, response)
+                return
+            content = response.read()
+            connection.close()
+        except OSError as e:
+            logging.warning('Capture process unreachable: %s', str(e))
+            self.send_error(502, 'Capture process unreachable')
+            return
+        self.send_response(response.status)
+        for name, value in response.getheaders():
+            if name.lower() in ('content-type', 'location'):
+                self.send_header(name, value)
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def relay(self, connection, response):
+        # Event streams (/lens) stay open; pass each event on as it comes.
+        self.send_response(response.status)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        try:
+            with worker.watchdog.watch(self) as watch:
+                while True:
+                    data = response.read1()
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    watch.progress()
+        except Exception as e:
+            logging.warning('Event stream client removed: %s', str(e))
+        finally:
+            connection.close()
+
+
+class FrontEndServer(socketserver.ThreadingMixIn, server.HTTPServer):
+    allow_reuse_address = True
+    allow_reuse_port = True
+    daemon_threads = True
+
+
+class Worker:
+    def __init__(self, index, control_address, pages, distorted, admission):
+        self.index = index
+        self.control_address = control_address
+        self.pages = pages
+        self.distorted = distorted
+        self.admission = admission
+        self.watchdog = Watchdog()
+        self.outputs = {}
+        self.lock = Lock()
+
+    def output(self, path, query):
+        # Same choice of stream as the capture process makes for a path.
+        name = path.strip('/')[:-len('.mjpg')]
+        if name.startswith(('roi', 'hq')) or name == 'depth':
+            bus = f'mandro_{name}_jpeg'
+        elif name in ('stream1', 'stream2') and parse_qs(query).get('mode') == ['gray']:
+            bus = f'mandro_gray_{name}_jpeg'
+        elif name in ('stream1', 'stream2'):
+            distorted = self.distorted.value and parse_qs(query).get('mode') != ['plain']
+            bus = f'mandro_distorted_{name}_jpeg' if distorted else f'mandro_{name}_jpeg'
+        else:
+            return None
+        with self.lock:
+            if bus not in self.outputs:
+                self.outputs[bus] = BusOutput(bus)
+            return self.outputs[bus]
+
+    def stats(self):
+        with self.lock:
+            outputs = {name: output.stats() for name, output in self.outputs.items()}
+        return {
+            'worker': self.index,
+            'pid': os.getpid(),
+            'outputs': outputs,
+            'admission': self.admission.stats(),
+            'handlers': self.watchdog.stats(),
+        }
+
+
+worker = None
+
+
+def watch_parent(parent):
+    # Don't keep serving stale frames on the port if the capture process
+    # dies without stopping us.
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+
+def run_worker(index, address, control_address, pages, distorted, limits, shared, parent):
+    global worker
+    Thread(target=watch_parent, args=(parent,), daemon=True).start()
+    worker = Worker(index, control_address, pages, distorted, Admission(*limits, shared=shared))
+    FrontEndServer(address, FrontEndHandler).serve_forever()
+
+
+class FrontEnd:
+    def __init__(self, workers, address, control_address, pages,
+                 per_camera_limit, global_limit, tokens):
+        # Fork before the cameras start their threads, like DistortionPool.
+        # The workers count their streams together against the limits.
+        ctx = multiprocessing.get_context('fork')
+        self.distorted = ctx.Value('b', False, lock=False)
+        self.streams = SharedCounts(ctx)
+        limits = (per_camera_limit, global_limit, tokens)
+        self.processes = [
+            ctx.Process(target=run_worker, daemon=True,
+                        args=(index, address, control_address, pages, self.distorted, limits, self.streams,
+                              os.getpid()))
+            for index in range(workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def stats(self):
+        return {'workers': [process.pid for process in self.processes if process.is_alive()],
+                'streams': list(self.streams.counts)}
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(timeout=1)
@@ -0,0 +1,249 @@
+# Lens pre-warp in the viewer's browser instead of on the Pi.
+#
+# /distorted.html shows the plain hardware-encoded streams and warps them
+# in a WebGL fragment shader: the same crop to square, rotation and per
+# channel barrel distortion as distortion.build_maps, evaluated per output
+# pixel on the GPU. The server sends untouched frames, so no decode, remap
+# or re-encode happens for these viewers however many there are.
+#
+# The page reads the lens settings from /lens, a server-sent event stream
+# that pushes new settings whenever /update changes them.
+
+import json
+from threading import Condition
+
+from distortion import framing
+
+# Comment lines on an idle event stream, well inside the proxies' and the
+# front-end workers' read timeouts.
+LENS_KEEPALIVE = 5
+
+GL_PAGE = """\
+<html>
+<head>
+<title>Mand.ro Picamera2 Client-side Distortion</title>
+<style>
+  body {
+    background: black;
+    margin: 0;
+    display: flex;
+    justify-content: center;
+    align-items: center;
+    height: 100vh;
+  }
+  .case {
+    display: flex;
+  }
+  .box {
+    width: 400px;
+    height: 400px;
+    border: 0px solid grey;
+  }
+  .box canvas {
+    width: 100%;
+    height: 100%;
+  }
+  .box img {
+    display: none;
+  }
+  .hori_1 canvas {
+    transform: rotate(90deg);
+  }
+  .hori_2 canvas {
+    transform: rotate(270deg);
+  }
+</style>
+</head>
+<body>
+<div class="case">
+    <div class="box hori_1">
+        <img src="stream1.mjpg?mode=plain">
+        <canvas></canvas>
+    </div>
+    <div class="box hori_2">
+        <img src="stream2.mjpg?mode=plain">
+        <canvas></canvas>
+    </div>
+</div>
+<script id="vertex" type="x-shader/x-vertex">
+attribute vec2 corner;
+varying vec2 position;
+void main() {
+  // position runs 0..1 from the top left, like image rows and columns.
+  position = vec2(corner.x + 1.0, 1.0 - corner.y) / 2.0;
+  gl_Position = vec4(corner, 0.0, 1.0);
+}
+</script>
+<script id="fragment" type="x-shader/x-fragment">
+precision highp float;
+uniform sampler2D frame;
+uniform vec2 size;
+uniform bool warp;
+uniform vec2 red;
+uniform vec2 green;
+uniform vec2 blue;
+uniform float rotation;
+uniform vec2 focal;
+uniform vec2 centre;
+varying vec2 position;
+
+// distortion.build_maps with the square crop's side as the unit of length.
+vec2 normalised(float side) {
+  float middle = 0.5 - 0.5 / side;
+  vec2 d = position - 0.5 / side - middle;
+  vec2 p = vec2(cos(rotation) * d.x + sin(rotation) * d.y,
+                -sin(rotation) * d.x + cos(rotation) * d.y) + middle;
+  return (p - centre) / focal;
+}
+
+float lookup(vec2 n, vec2 k, float side, int channel) {
+  float r2 = dot(n, n);
+  vec2 m = n * (1.0 + k.x * r2 + k.y * r2 * r2) + 0.5;
+  // Anything outside the square crop stays black, as if it had been cut.
+  if (m.x < 0.0 || m.y < 0.0 || m.x * side > side - 1.0 || m.y * side > side - 1.0) {
+    return 0.0;
+  }
+  vec4 texel = texture2D(frame, ((size - side) / 2.0 + m * side + 0.5) / size);
+  return channel == 0 ? texel.r : channel == 1 ? texel.g : texel.b;
+}
+
+void main() {
+  if (!warp) {
+    gl_FragColor = texture2D(frame, position);
+    return;
+  }
+  float side = min(size.x, size.y);
+  vec2 n = normalised(side);
+  gl_FragColor = vec4(lookup(n, red, side, 0), lookup(n, green, side, 1), lookup(n, blue, side, 2), 1.0);
+}
+</script>
+<script>
+var lens = null;
+
+function compile(gl, type, id) {
+  var shader = gl.createShader(type);
+  gl.shaderSource(shader, document.getElementById(id).text);
+  gl.compileShader(shader);
+  if (!gl.getShaderParameter(shader, gl.COMPILE_STATUS)) {
+    throw new Error(gl.getShaderInfoLog(shader));
+  }
+  return shader;
+}
+
+function View(box) {
+  var img = box.querySelector('img');
+  var canvas = box.querySelector('canvas');
+  var gl = canvas.getContext('webgl');
+  var program = gl.createProgram();
+  gl.attachShader(program, compile(gl, gl.VERTEX_SHADER, 'vertex'));
+  gl.attachShader(program, compile(gl, gl.FRAGMENT_SHADER, 'fragment'));
+  gl.linkProgram(program);
+  gl.useProgram(program);
+
+  gl.bindBuffer(gl.ARRAY_BUFFER, gl.createBuffer());
+  gl.bufferData(gl.ARRAY_BUFFER, new Float32Array([-1, -1, 1, -1, -1, 1, 1, 1]), gl.STATIC_DRAW);
+  var corner = gl.getAttribLocation(program, 'corner');
+  gl.enableVertexAttribArray(corner);
+  gl.vertexAttribPointer(corner, 2, gl.FLOAT, false, 0, 0);
+
+  // Frames aren't powers of two: no mipmaps, no repeat.
+  gl.bindTexture(gl.TEXTURE_2D, gl.createTexture());
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MIN_FILTER, gl.LINEAR);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MAG_FILTER, gl.LINEAR);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_S, gl.CLAMP_TO_EDGE);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_T, gl.CLAMP_TO_EDGE);
+
+  var uniforms = {};
+  ['size', 'warp', 'red', 'green', 'blue', 'rotation', 'focal', 'centre'].forEach(function (name) {
+    uniforms[name] = gl.getUniformLocation(program, name);
+  });
+
+  this.draw = function () {
+    var width = img.naturalWidth, height = img.naturalHeight;
+    if (!lens || !width) return;
+    var warp = lens.distorted;
+    var side = Math.min(width, height);
+    var output = warp ? (lens.output_size || [side, side]) : [width, height];
+    if (canvas.width !== output[0] || canvas.height !== output[1]) {
+      canvas.width = output[0];
+      canvas.height = output[1];
+    }
+    gl.viewport(0, 0, canvas.width, canvas.height);
+    // The img always shows the newest frame of its stream.
+    gl.texImage2D(gl.TEXTURE_2D, 0, gl.RGB, gl.RGB, gl.UNSIGNED_BYTE, img);
+    gl.uniform2f(uniforms.size, width, height);
+    gl.uniform1i(uniforms.warp, warp ? 1 : 0);
+    gl.uniform2fv(uniforms.red, lens.red);
+    gl.uniform2fv(uniforms.green, lens.green);
+    gl.uniform2fv(uniforms.blue, lens.blue);
+    gl.uniform1f(uniforms.rotation, lens.rotation * Math.PI / 180);
+    gl.uniform2fv(uniforms.focal, lens.focal);
+    gl.uniform2fv(uniforms.centre, lens.centre);
+    gl.drawArrays(gl.TRIANGLE_STRIP, 0, 4);
+  };
+}
+
+var views = Array.prototype.map.call(document.querySelectorAll('.box'), function (box) {
+  return new View(box);
+});
+function frame() {
+  views.forEach(function (view) { view.draw(); });
+  requestAnimationFrame(frame);
+}
+requestAnimationFrame(frame);
+
+new EventSource('/lens').onmessage = function (e) {
+  lens = JSON.parse(e.data);
+};
+</script>
+</body>
+</html>"""
+
+
+def lens_settings(profile, distorted):
+    # What the shader needs from a LensProfile. The framing scales with the
+    # crop, so it goes out for a unit square.
+    side = 1000
+    new_camera_matrix = framing(profile, side)
+    return {
+        'distorted': distorted,
+        'red': list(profile.red),
+        'green': list(profile.green),
+        'blue': list(profile.blue),
+        'rotation': profile.rotation,
+        'output_size': list(profile.output_size) if profile.output_size else None,
+        'focal': [float(new_camera_matrix[0, 0]) / side, float(new_camera_matrix[1, 1]) / side],
+        'centre': [float(new_camera_matrix[0, 2]) / side, float(new_camera_matrix[1, 2]) / side],
+    }
+
+
+class LensFeed:
+    # The current settings as a server-sent event, and a condition the
+    # /lens handlers wait on for the next one.
+    def __init__(self, settings):
+        self.condition = Condition()
+        self.event = None
+        self.version = 0
+        self.clients = 0
+        self.publish(settings)
+
+    def publish(self, settings):
+        event = b'data: ' + json.dumps(settings).encode('utf-8') + b'\n\n'
+        with self.condition:
+            if event == self.event:
+                return
+            self.event = event
+            self.version += 1
+            self.condition.notify_all()
+
+    def next(self, version, timeout=LENS_KEEPALIVE):
+        # (event, version) once there is a newer event than version, or
+        # (None, version) after timeout.
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            if self.version == version:
+                return None, version
+            return self.event, self.version
+
+    def stats(self):
+        return {'version': self.version, 'clients': self.clients}
@@ -0,0 +1,135 @@
+# Receiver-side jitter buffer for the UDP video stream.
+#
+# Frames are held for a target delay and released in sequence order, paced
+# by their capture timestamps. A frame that turns up after a later one has
+# already been shown is dropped rather than making the picture jump back.
+# With adaptive=True the delay follows the measured jitter (RFC 3550 style
+# interarrival estimate) between delay and max_delay.
+#
+# Sequence numbers are 32 bits on the wire and are unwrapped around the
+# highest one seen. A frame behind that means the sender restarted, and the
+# buffer starts over instead of dropping every frame as late until the new
+# numbers catch up, when it is more than REORDER_WINDOW behind (like
+# udp_relay.RelayOutput), or when its capture timestamp gives it away
+# sooner: newer than the highest frame's, which a reordered frame's never
+# is, or more than RESTART_GAP seconds older, as after a clock reset.
+
+from threading import Lock
+
+SEQ_MASK = 0xFFFFFFFF
+REORDER_WINDOW = 64
+RESTART_GAP = 5.0
+
+
+class JitterBuffer:
+    def __init__(self, delay=0.05, adaptive=True, max_delay=0.5, capacity=64):
+        self.min_delay = delay
+        self.delay = delay
+        self.adaptive = adaptive
+        self.max_delay = max_delay
+        self.capacity = capacity
+        self.frames = {}
+        self.offset = None
+        self.jitter = 0.0
+        self.last_transit = None
+        self.highest_seq = None
+        self.highest_timestamp = None
+        self.last_played = None
+        self.played = 0
+        self.reordered = 0
+        self.late = 0
+        self.lost = 0
+        self.overflow = 0
+        self.restarts = 0
+        self.lock = Lock()
+
+    def unwrap(self, seq, timestamp):
+        if self.highest_seq is None:
+            return seq
+        delta = (seq - self.highest_seq) & SEQ_MASK
+        if delta > SEQ_MASK // 2:
+            delta -= SEQ_MASK + 1
+        if delta < 0 and (delta < -REORDER_WINDOW or timestamp > self.highest_timestamp
+                          or timestamp < self.highest_timestamp - RESTART_GAP):
+            self.restart()
+            return seq
+        return self.highest_seq + delta
+
+    def restart(self):
+        self.restarts += 1
+        self.frames.clear()
+        self.offset = None
+        self.last_transit = None
+        self.highest_seq = None
+        self.highest_timestamp = None
+        self.last_played = None
+
+    def push(self, seq, timestamp, payload, arrival):
+        transit = arrival - timestamp
+        with self.lock:
+            seq = self.unwrap(seq, timestamp)
+            # The smallest transit seen stands in for the clock offset between
+            # sender and receiver; let it creep up slowly to follow drift.
+            if self.offset is None or transit < self.offset:
+                self.offset = transit
+            else:
+                self.offset += (transit - self.offset) * 0.001
+
+            if self.last_transit is not None:
+                self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+            self.last_transit = transit
+            if self.adaptive:
+                self.delay = min(max(self.min_delay, 4 * self.jitter), self.max_delay)
+
+            if self.highest_seq is not None and seq < self.highest_seq:
+                self.reordered += 1
+            else:
+                self.highest_seq = seq
+                self.highest_timestamp = timestamp
+
+            if self.last_played is not None and seq <= self.last_played or seq in self.frames:
+                self.late += 1
+                return False
+            if len(self.frames) >= self.capacity:
+                self.overflow += 1
+                self.frames.pop(min(self.frames))
+            self.frames[seq] = (timestamp, payload)
+            return True
+
+    def playout_time(self, timestamp):
+        return timestamp + self.offset + self.delay
+
+    def pop(self, now):
+        with self.lock:
+            if not self.frames:
+                return None
+            seq = min(self.frames)
+            timestamp, payload = self.frames[seq]
+            if self.playout_time(timestamp) > now:
+                return None
+            del self.frames[seq]
+            if self.last_played is not None and seq > self.last_played + 1:
+                self.lost += seq - self.last_played - 1
+            self.last_played = seq
+            self.played += 1
+            return seq & SEQ_MASK, payload
+
+    def next_due(self):
+        with self.lock:
+            if not self.frames:
+                return None
+            return self.playout_time(self.frames[min(self.frames)][0])
+
+    def stats(self):
+        with self.lock:
+            return {
+                'delay_ms': round(self.delay * 1000, 1),
+                'jitter_ms': round(self.jitter * 1000, 2),
+                'buffered': len(self.frames),
+                'played': self.played,
+                'reordered': self.reordered,
+                'late': self.late,
+                'lost': self.lost,
+                'overflow': self.overflow,
+                'restarts': self.restarts,
+            }
@@ -0,0 +1,134 @@
+# The one place software JPEGs are made, for every stream the hardware
+# encoder doesn't do: distorted, ROI, gray, depth and the UDP senders.
+#
+# Each stream has a named profile: quality, chroma subsampling, Huffman
+# optimisation (smaller, slower), progressive (never, for live video) and
+# restart markers every restart_interval MCUs, so a corrupted byte costs a
+# stripe rather than the rest of the frame.
+#
+# simplejpeg, when it's installed, is used for the profiles it can do (no
+# optimise, progressive or restart markers): it encodes YUV420 planes as
+# they are, so ROI frames skip the conversion to BGR, and uses the fast DCT.
+# Otherwise OpenCV encodes, with I420 converted into a reused BGR buffer.
+# Either way the JPEG itself is a new buffer per frame: it's handed on to
+# outputs that keep it until the next one.
+
+import time
+from threading import Lock
+
+import cv2
+import numpy as np
+
+from buffers import ArrayPool
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+
+class JpegProfile:
+    def __init__(self, quality=75, subsampling='420', optimize=False, progressive=False, restart_interval=0):
+        self.quality = quality
+        # '444', '422', '420', '440' or '411'; ignored for single-channel images.
+        self.subsampling = subsampling
+        self.optimize = optimize
+        self.progressive = progressive
+        self.restart_interval = restart_interval
+
+    def cv2_params(self):
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality,
+                  cv2.IMWRITE_JPEG_OPTIMIZE, int(self.optimize),
+                  cv2.IMWRITE_JPEG_PROGRESSIVE, int(self.progressive),
+                  cv2.IMWRITE_JPEG_RST_INTERVAL, self.restart_interval]
+        sampling = getattr(cv2, f'IMWRITE_JPEG_SAMPLING_FACTOR_{self.subsampling}', None)
+        if sampling is not None:
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, sampling]
+        return params
+
+    def fast_path(self):
+        return simplejpeg is not None and not (self.optimize or self.progressive or self.restart_interval)
+
+
+PROFILES = {
+    'distorted': JpegProfile(quality=60),
+    'roi': JpegProfile(quality=75),
+    'gray': JpegProfile(quality=80),
+    'depth': JpegProfile(quality=70),
+    # Over the radio: small frames, and a lost chunk only smears a stripe.
+    'udp': JpegProfile(quality=60, restart_interval=20),
+}
+
+
+class JpegEncoder:
+    def __init__(self, profile):
+        self.profile = profile
+        self.params = profile.cv2_params()
+        self.fast = profile.fast_path()
+        self.pool = ArrayPool()
+        self.lock = Lock()
+        self.frames = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def encode(self, image):
+        # BGR (height, width, 3) or gray (height, width) -> memoryview.
+        started = time.perf_counter()
+        if self.fast and image.flags.c_contiguous:
+            if image.ndim == 2:
+                jpeg = simplejpeg.encode_jpeg(image[:, :, np.newaxis], self.profile.quality,
+                                              colorspace='GRAY', colorsubsampling='Gray', fastdct=True)
+            else:
+                jpeg = simplejpeg.encode_jpeg(image, self.profile.quality, colorspace='BGR',
+                                              colorsubsampling=self.profile.subsampling, fastdct=True)
+            return self.done(memoryview(jpeg), started)
+        _, jpeg = cv2.imencode('.jpg', image, self.params)
+        return self.done(memoryview(jpeg.reshape(-1)), started)
+
+    def encode_i420(self, buffer, width, height):
+        # buffer: I420 as (height * 3 // 2, width), Y then U then V.
+        started = time.perf_counter()
+        if self.fast and hasattr(simplejpeg, 'encode_jpeg_yuv_planes'):
+            chroma = buffer[height:].reshape(2, height // 2, width // 2)
+            jpeg = simplejpeg.encode_jpeg_yuv_planes(buffer[:height], chroma[0], chroma[1],
+                                                     self.profile.quality, fastdct=True)
+            return self.done(memoryview(jpeg), started)
+        image = cv2.cvtColor(buffer, cv2.COLOR_YUV2BGR_I420, dst=self.pool.get('bgr', (height, width, 3)))
+        _, jpeg = cv2.imencode('.jpg', image, self.params)
+        return self.done(memoryview(jpeg.reshape(-1)), started)
+
+    def done(self, jpeg, started):
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.frames += 1
+            self.bytes += jpeg.nbytes
+            self.seconds += elapsed
+        return jpeg
+
+    def stats(self):
+        with self.lock:
+            frames = max(self.frames, 1)
+            return {
+                'simplejpeg': self.fast,
+                'quality': self.profile.quality,
+                'frames': self.frames,
+                'encode_ms': round(self.seconds / frames * 1000, 2),
+                'bytes_per_frame': self.bytes // frames,
+            }
+
+
+# One encoder per profile, shared by the streams that use it.
+encoders = {}
+encoders_lock = Lock()
+
+
+def encoder(name):
+    with encoders_lock:
+        if name not in encoders:
+            encoders[name] = JpegEncoder(PROFILES[name])
+        return encoders[name]
+
+
+def stats():
+    with encoders_lock:
+        return {name: encoder.stats() for name, encoder in encoders.items()}
@@ -0,0 +1,136 @@
+# Grayscale streaming for consumers that never needed colour (line
+# following, fiducials).
+#
+# The Y plane at the top of a YUV420 buffer already is the grayscale image,
+# so it's used in place: no colour conversion, no copy. It goes out as a
+# single-channel JPEG ('gray'), or as zlib-compressed luma for consumers
+# that want exact pixels: 'luma' sends every frame whole, 'delta' sends the
+# difference from the last keyframe, which is mostly zeros for a camera
+# that isn't moving. Deltas are against the keyframe, not the previous
+# frame, so a lost frame only costs that frame.
+#
+# GrayStream moves the gray JPEG encode off the camera callback: the
+# callback only copies the Y plane into a free buffer, and a thread encodes
+# the newest one, like RoiStream and DepthStream.
+
+import struct
+import time
+import zlib
+from threading import Condition, Thread
+
+import numpy as np
+
+from jpeg_encoder import encoder
+
+MODES = ('colour', 'gray', 'luma', 'delta')
+KEYFRAME_INTERVAL = 25
+
+#   width, height  HH
+#   key            B   1 for a keyframe, 0 for a delta
+#   key_id         I   keyframe number; a delta applies to that keyframe
+LUMA_HEADER = struct.Struct('!HHBI')
+
+
+def encode_gray(luma):
+    return encoder('gray').encode(luma)
+
+
+class GrayStream:
+    def __init__(self, output, frame_size, buffers=3):
+        self.output = output
+        width, height = frame_size
+        self.free = [np.empty((height, width), np.uint8) for _ in range(buffers)]
+        self.pending = None
+        self.condition = Condition()
+        self.frames = 0
+        self.dropped = 0
+        self.encode_seconds = 0.0
+        Thread(target=self.encode_loop, daemon=True).start()
+
+    def wanted(self):
+        return self.output.wanted()
+
+    def submit(self, luma, frame_id=None):
+        # Called from the camera callback with the Y plane.
+        with self.condition:
+            if not self.free:
+                self.dropped += 1
+                return
+            buffer = self.free.pop()
+        np.copyto(buffer, luma)
+        with self.condition:
+            if self.pending is not None:
+                self.free.append(self.pending[0])
+                self.dropped += 1
+            self.pending = (buffer, frame_id)
+            self.condition.notify()
+
+    def encode_loop(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                buffer, frame_id = self.pending
+                self.pending = None
+            started = time.perf_counter()
+            jpeg = encode_gray(buffer)
+            self.encode_seconds += time.perf_counter() - started
+            with self.condition:
+                self.free.append(buffer)
+            self.frames += 1
+            self.output.write(jpeg, frame_id)
+
+    def stats(self):
+        frames = max(self.frames, 1)
+        return {
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'encode_ms': round(self.encode_seconds / frames * 1000, 2),
+        }
+
+
+class LumaEncoder:
+    def __init__(self, delta=True, keyframe_interval=KEYFRAME_INTERVAL, level=1):
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.level = level
+        self.key = None
+        self.key_id = 0
+        self.since_key = 0
+
+    def encode(self, luma):
+        height, width = luma.shape
+        if not self.delta or self.key is None or self.key.shape != luma.shape \
+                or self.since_key >= self.keyframe_interval:
+            self.key_id = (self.key_id + 1) & 0xFFFFFFFF
+            if self.delta:
+                self.key = np.array(luma)
+                self.since_key = 0
+            data = np.ascontiguousarray(luma)
+            return LUMA_HEADER.pack(width, height, 1, self.key_id) + zlib.compress(data, self.level)
+        self.since_key += 1
+        # uint8 arithmetic wraps, which is exactly what the decoder undoes.
+        difference = luma - self.key
+        return LUMA_HEADER.pack(width, height, 0, self.key_id) + zlib.compress(difference, self.level)
+
+
+class LumaDecoder:
+    def __init__(self):
+        self.keys = {}
+        self.missing_key = 0
+
+    def decode(self, payload):
+        width, height, key, key_id = LUMA_HEADER.unpack_from(payload)
+        image = np.frombuffer(zlib.decompress(payload[LUMA_HEADER.size:]), dtype=np.uint8).reshape(height, width)
+        if key:
+            # Keep a couple of keyframes: deltas may still arrive for the
+            # previous one after a new one has been played.
+            self.keys[key_id] = image
+            for old in list(self.keys)[:-2]:
+                del self.keys[old]
+            return image
+        base = self.keys.get(key_id)
+        if base is None or base.shape != image.shape:
+            self.missing_key += 1
+            return None
+        return image + base
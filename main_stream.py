@@ -0,0 +1,109 @@
+# What the full-resolution main stream costs, and two ways to stop paying
+# for it unused.
+#
+# picamera2 always configures a main stream, and every buffer of every
+# stream is allocated up front in CMA memory and written by the ISP on every
+# frame, whether anything reads it or not. With encode="lores":
+#
+#   low  main is shrunk to the lores size, the least the ISP accepts (lores
+#        can't be larger than main);
+#   hq   main stays at full size and HqStream encodes it with a second
+#        hardware encoder at a low frame rate, only while it has viewers.
+#
+# memory_stats() reports the buffers a configured camera holds and the bytes
+# per second the ISP moves for it.
+
+import logging
+import time
+from threading import Thread
+
+try:
+    from picamera2.encoders import MJPEGEncoder, Quality
+    from picamera2.outputs import FileOutput
+except ImportError:
+    MJPEGEncoder = None
+
+MAIN_MODES = ('low', 'hq')
+HQ_SIZE = (1640, 1232)
+HQ_FPS = 5.0
+
+
+def main_config(mode, lores_size, hq_size=HQ_SIZE):
+    return {"size": lores_size if mode == 'low' else hq_size, "format": "YUV420"}
+
+
+def frame_bytes(stream):
+    framesize = stream.get('framesize')
+    if framesize:
+        return framesize
+    stride = stream.get('stride') or stream['size'][0]
+    return stride * stream['size'][1] * 3 // 2 if stream['format'] == 'YUV420' else stride * stream['size'][1]
+
+
+def memory_stats(picam, fps):
+    config = picam.camera_configuration()
+    count = config['buffer_count']
+    frames = {name: frame_bytes(config[name]) for name in ('main', 'lores', 'raw') if config.get(name)}
+    return {
+        'buffer_count': count,
+        'sizes': {name: list(config[name]['size']) for name in frames},
+        'buffers': {name: size * count for name, size in frames.items()},
+        'total': sum(frames.values()) * count,
+        # The ISP reads the raw frame and writes each output stream.
+        'isp_read': round(frames.get('raw', 0) * fps),
+        'isp_write': round((frames.get('main', 0) + frames.get('lores', 0)) * fps),
+    }
+
+
+class HqStream:
+    # Encodes main into output, every camera_fps / fps'th frame, while
+    # output.wanted(); the encoder is stopped again after linger seconds
+    # without viewers.
+    def __init__(self, picam, output, camera_fps, fps=HQ_FPS, quality='HIGH', linger=5.0):
+        self.picam = picam
+        self.output = output
+        self.skip = max(1, round(camera_fps / fps))
+        self.quality = quality
+        self.linger = linger
+        self.encoder = None
+        self.starts = 0
+        self.failed = 0
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        idle_since = None
+        while True:
+            time.sleep(0.5)
+            now = time.monotonic()
+            if self.output.wanted():
+                idle_since = None
+                if self.encoder is None:
+                    self.start()
+            elif self.encoder is not None:
+                if idle_since is None:
+                    idle_since = now
+                elif now - idle_since > self.linger:
+                    self.stop()
+
+    def start(self):
+        encoder = MJPEGEncoder()
+        encoder.frame_skip_count = self.skip
+        try:
+            self.picam.start_encoder(encoder, FileOutput(self.output), name='main', quality=Quality[self.quality])
+        except Exception as e:
+            self.failed += 1
+            logging.warning('Could not start the main stream encoder: %s', str(e))
+            return
+        self.encoder = encoder
+        self.starts += 1
+
+    def stop(self):
+        try:
+            self.picam.stop_encoder(self.encoder)
+        except Exception as e:
+            logging.warning('Could not stop the main stream encoder: %s', str(e))
+        self.encoder = None
+
+    def stats(self):
+        return {'running': self.encoder is not None, 'starts': self.starts, 'failed': self.failed,
+                'frame_skip': self.skip}
@@ -0,0 +1,67 @@
+# The multipart MJPEG response every stream handler sends, in the capture
+# process (camera_integ, camera_custom) and in the front-end workers.
+#
+# output is anything with condition, frame, frame_id, timestamp, clients
+# and sent: a StreamingOutput, or a front end's BusOutput. The query's
+# fps/every are checked before a slot is taken, and once one is taken
+# everything runs inside the try that gives it back.
+
+import logging
+import time
+
+from pacing import FramePacer
+from tracing import now
+
+
+def serve_stream(handler, output, camera, cls, query, admission, watchdog, tracer=None):
+    try:
+        pacer = FramePacer.from_query(query)
+    except ValueError:
+        handler.send_error(400, 'fps and every must be numbers')
+        return
+    ticket = admission.acquire(camera, cls)
+    if ticket is None:
+        handler.send_error(503, 'Stream limit reached')
+        return
+    with output.condition:
+        output.clients += 1
+    try:
+        ticket.pacer = pacer
+        handler.send_response(200)
+        handler.send_header('Age', 0)
+        handler.send_header('Cache-Control', 'no-cache, private')
+        handler.send_header('Pragma', 'no-cache')
+        handler.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+        handler.end_headers()
+
+        with watchdog.watch(handler) as watch:
+            while not ticket.evicted:
+                with output.condition:
+                    watch.wait(output.condition)
+                    frame = output.frame
+                    frame_id = output.frame_id
+                    timestamp = output.timestamp
+
+                if not pacer.admit(timestamp, admission.max_fps(cls)):
+                    watch.progress()
+                    continue
+
+                started = now() if tracer is not None and tracer.sampled(frame_id) else None
+                queued = time.monotonic() - timestamp
+                handler.wfile.write(b'--FRAME\r\n')
+                handler.send_header('Content-Type', 'image/jpeg')
+                handler.send_header('Content-Length', len(frame))
+                handler.end_headers()
+                handler.wfile.write(frame)
+                handler.wfile.write(b'\r\n')
+                if started is not None:
+                    tracer.span('send', started, now(), stream=getattr(output, 'name', None), frame=frame_id,
+                                client='%s:%d' % handler.client_address[:2], queued_ms=round(queued * 1000, 2))
+                output.sent += len(frame)
+                watch.progress()
+    except Exception as e:
+        logging.warning('Streaming client %s removed: %s', handler.client_address, str(e))
+    finally:
+        admission.release(ticket)
+        with output.condition:
+            output.clients -= 1
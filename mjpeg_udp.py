@@ -1,41 +1,147 @@
-from picamera2 import Picamera2
+import os
 import socket
 import time
 import numpy as np
 import cv2
 
-from libcamera import Transform
+try:
+    from picamera2 import MappedArray, Picamera2
+except ImportError:
+    # Replaying a recording needs no camera stack, so it runs on any box.
+    Picamera2 = None
 
-connectedDevices = {}
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+from buffers import ArrayPool, tracker
+from change_gate import ChangeGate
+from recorder import Recorder, ReplayCamera
+from fec import FecController
+import jpeg_encoder
+from jpeg_encoder import encoder
+from luma import MODES, LumaEncoder, encode_gray
+from udp_proto import CHUNK_SIZE, FORMAT_JPEG, FORMAT_LUMA, read_feedback, send_frame
 
-picam2 = Picamera2(1)
-picam2.options["quality"] = 60
-picam2.configure(picam2.create_video_configuration(
-        buffer_count = 3,
-        queue = False,
-        main={"size": (1640, 1232), "format": "RGB888"}))
-picam2.start()
+CHANGE_GATE = True
+KEEPALIVE_FPS = 1.0
+STATS_INTERVAL = 10
+# Send parity chunks with every frame, between FEC_MIN_OVERHEAD and
+# FEC_MAX_OVERHEAD of the data depending on the loss the receiver reports.
+FEC = True
+FEC_MIN_OVERHEAD = 0.1
+FEC_MAX_OVERHEAD = 0.5
+# Record the sent frames to RECORD_PATH, or send a recording from
+# REPLAY_PATH instead of the camera. REPLAY_SPEED 0 sends as fast as possible.
+RECORD_PATH = os.environ.get('RECORD_PATH')
+REPLAY_PATH = os.environ.get('REPLAY_PATH')
+REPLAY_SPEED = float(os.environ.get('REPLAY_SPEED', '1'))
+FRAME_SIZE = (320, 240)
+# Until the receiver asks for another one (see luma.MODES).
+DEFAULT_MODE = 'colour'
 
-time.sleep(2)
+connectedDevices = {}
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 device_id = '1'
+gate = ChangeGate(keepalive_fps=KEEPALIVE_FPS) if CHANGE_GATE else None
+pool = ArrayPool()
+recorder = Recorder(RECORD_PATH) if RECORD_PATH else None
+fec = FecController(FEC_MIN_OVERHEAD, FEC_MAX_OVERHEAD) if FEC else None
+mode = MODES.index(DEFAULT_MODE)
+luma_encoders = {'luma': LumaEncoder(delta=False), 'delta': LumaEncoder(delta=True)}
 
-try:
+
+def camera_frames(picam2):
     while True:
-        frame = picam2.capture_array()
+        # Work on the camera buffer in place instead of copying it out with
+        # capture_array(), and resize into a buffer reused every frame.
+        request = picam2.capture_request()
+        name = MODES[mode]
+        data = None
+        try:
+            if name != 'colour':
+                # Grayscale straight from the Y plane of the lores buffer,
+                # encoded before the buffer goes back to the camera.
+                with MappedArray(request, 'lores') as m:
+                    luma = m.array[:FRAME_SIZE[1], :FRAME_SIZE[0]]
+                    if gate is not None:
+                        gate.observe(luma)
+                        if not gate.admit():
+                            continue
+                    if name == 'gray':
+                        data, fmt = encode_gray(luma), FORMAT_JPEG
+                    else:
+                        data, fmt = luma_encoders[name].encode(luma), FORMAT_LUMA
+            else:
+                with MappedArray(request, 'main') as m:
+                    if gate is not None:
+                        gate.observe_rgb(m.array)
+                        if not gate.admit():
+                            continue
+                    frame_resized = cv2.resize(m.array, FRAME_SIZE, dst=pool.get('resized', FRAME_SIZE[::-1] + (3,)))
+            timestamp_us = request.get_metadata()['SensorTimestamp'] // 1000
+        finally:
+            request.release()
 
-        frame_resized = cv2.resize(frame, (320, 240))
+        if data is None:
+            data, fmt = encoder('udp').encode(frame_resized), FORMAT_JPEG
+        tracker.allocated(len(data))
+        yield data, timestamp_us, fmt
+
+
+if REPLAY_PATH:
+    camera = ReplayCamera(REPLAY_PATH, REPLAY_SPEED)
+    # Restamp with the send time: the recorded clock restarts on every loop.
+    frames = ((frame, time.monotonic_ns() // 1000, FORMAT_JPEG) for frame, _ in camera.frames())
+else:
+    camera = Picamera2(1)
+    camera.options["quality"] = 60
+    camera.configure(camera.create_video_configuration(
+            buffer_count = 3,
+            queue = False,
+            main={"size": (1640, 1232), "format": "RGB888"},
+            lores={"size": FRAME_SIZE}))
+    camera.start()
+
+    time.sleep(2)
+    frames = camera_frames(camera)
+
+seq = 0
+last_stats = time.monotonic()
+
+try:
+    for data, timestamp_us, fmt in frames:
+        tracker.frame()
 
-        _, buffer = cv2.imencode(".jpg",frame_resized )
+        feedback = read_feedback(sock)
+        if feedback is not None:
+            loss, requested = feedback
+            if fec is not None:
+                fec.loss = loss
+            if requested != mode and requested < len(MODES) and not REPLAY_PATH:
+                mode = requested
+                print(f"mode: {MODES[mode]}")
+        parity = fec.parity_for(-(-len(data) // CHUNK_SIZE)) if fec is not None else 0
+        send_frame(sock, ('192.168.0.138', 7000), seq, timestamp_us, data, parity, fmt=fmt)
+        seq += 1
 
-        sock.sendto(buffer.tobytes(), ('192.168.0.138', 7000))
+        if fmt == FORMAT_JPEG:
+            connectedDevices[device_id] = {'image': data}
+            if recorder is not None:
+                recorder.write(data, timestamp_us)
 
-        connectedDevices[device_id] = {'image': buffer.tobytes()}
+        if time.monotonic() - last_stats >= STATS_INTERVAL:
+            last_stats = time.monotonic()
+            print(f"allocations: {tracker.stats()}")
+            print(f"jpeg: {jpeg_encoder.stats()}")
+            if gate is not None:
+                print(f"gate: {gate.stats()}")
+            if fec is not None:
+                print(f"fec: {fec.stats()}, parity {parity}")
 
 except KeyboardInterrupt:
     print("stop")
 
 finally:
-    picam2.stop()
+    if not REPLAY_PATH:
+        camera.stop()
+    if recorder is not None:
+        recorder.close()
     sock.close()
@@ -1,21 +1,206 @@
+import collections
+import os
 import socket
+import threading
+import time
 import cv2
 import numpy as np
 
+from jitter_buffer import JitterBuffer
+from recorder import Recorder
+from luma import MODES, LumaDecoder
+from udp_proto import FORMAT_LUMA, FrameAssembler, send_feedback
+from udp_receive import Receiver
+from udp_relay import Relay, RelayServer
+
+JITTER_DELAY = 0.05
+ADAPTIVE_JITTER = True
+STATS_INTERVAL = 10
+# Socket receive buffer in bytes; the kernel caps it at net.core.rmem_max.
+RECEIVE_BUFFER = int(os.environ.get('RECEIVE_BUFFER', 8 * 1024 * 1024))
+# How often the measured chunk loss is reported back to the sender, which
+# sizes its FEC parity from it.
+FEEDBACK_INTERVAL = 0.5
+# Record every received frame to RECORD_PATH (.seg/.idx) for later replay;
+# camera n > 0 goes to RECORD_PATH_n.
+RECORD_PATH = os.environ.get('RECORD_PATH')
+# Stream mode to ask the sender for: colour, gray (single-channel JPEG of
+# the Y plane), luma (raw luma) or delta (luma as keyframe deltas).
+MODE = os.environ.get('MODE', 'colour')
+# Show cameras 0 and 1 side by side, paired by capture time, when both
+# frames were captured within STEREO_TOLERANCE seconds of each other.
+STEREO = os.environ.get('STEREO') == '1'
+STEREO_TOLERANCE = 0.02
+# Run headless and re-serve every sender's cameras over HTTP on this port
+# instead of showing them (see udp_relay.py); JPEG modes only.
+RELAY_PORT = int(os.environ.get('RELAY_PORT', '0'))
+if RELAY_PORT and MODE not in ('colour', 'gray'):
+    print(f"MODE={MODE} isn't JPEG; relaying colour instead")
+    MODE = 'colour'
+
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 sock.bind(('0.0.0.0', 7000))
+receiver = Receiver(sock, rcvbuf=RECEIVE_BUFFER)
+
+# One assembler per sender, so several robots' frame numbers never mix.
+assemblers = {}
+relay = Relay() if RELAY_PORT else None
+
+
+class CameraStream:
+    # One camera's pipeline: its own jitter buffer and a decode thread that
+    # leaves the newest decoded frame in a slot for display, plus a short
+    # history of decoded frames for stereo pairing.
+    def __init__(self, camera):
+        self.camera = camera
+        self.jitter = JitterBuffer(JITTER_DELAY, ADAPTIVE_JITTER)
+        self.luma_decoder = LumaDecoder()
+        self.recorder = None
+        if RECORD_PATH:
+            self.recorder = Recorder(RECORD_PATH if camera == 0 else f'{RECORD_PATH}_{camera}')
+        self.condition = threading.Condition()
+        self.latest = None
+        self.shown = None
+        self.history = collections.deque(maxlen=8)
+        self.decoded = 0
+        self.failed = 0
+        self.fps = 0.0
+        self.last_decoded = None
+        threading.Thread(target=self.decode_loop, daemon=True).start()
+
+    def push(self, seq, timestamp_us, fmt, payload, arrival):
+        self.jitter.push(seq, timestamp_us / 1e6, (timestamp_us, fmt, payload), arrival)
+        if self.recorder is not None and fmt != FORMAT_LUMA:
+            self.recorder.write(payload, timestamp_us)
+        with self.condition:
+            self.condition.notify()
+
+    def decode_loop(self):
+        while True:
+            item = self.jitter.pop(time.monotonic())
+            if item is None:
+                due = self.jitter.next_due()
+                wait = 0.01 if due is None else min(max(due - time.monotonic(), 0.001), 0.01)
+                with self.condition:
+                    self.condition.wait(wait)
+                continue
+            seq, (timestamp_us, fmt, payload) = item
+            if fmt == FORMAT_LUMA:
+                frame = self.luma_decoder.decode(payload)
+            else:
+                # Gray JPEGs decode to one channel, colour ones to BGR.
+                frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            if frame is None:
+                self.failed += 1
+                continue
+
+            now = time.monotonic()
+            if self.last_decoded is not None and now > self.last_decoded:
+                self.fps += (1 / (now - self.last_decoded) - self.fps) / 16
+            self.last_decoded = now
+            self.decoded += 1
+            self.latest = (seq, timestamp_us, frame)
+            self.history.append((timestamp_us, frame))
+
+    def stats(self):
+        return {'fps': round(self.fps, 1), 'decoded': self.decoded, 'failed': self.failed,
+                'jitter': self.jitter.stats()}
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
 
+
+streams = {}
+
+
+def receive():
+    legacy_seq = 0
+    last_feedback = time.monotonic()
+    while True:
+        # One system call for every datagram queued; each is a view of the
+        # receiver's buffers, only good until the next receive().
+        for data, addr in receiver.receive():
+            arrival = time.monotonic()
+            assembler = assemblers.get(addr)
+            if assembler is None:
+                assembler = assemblers[addr] = FrameAssembler()
+            if arrival - last_feedback >= FEEDBACK_INTERVAL:
+                last_feedback = arrival
+                for sender, sender_assembler in list(assemblers.items()):
+                    send_feedback(sock, sender, sender_assembler.loss, MODES.index(MODE))
+            frame = assembler.add(data, arrival)
+            if frame is None:
+                continue
+            camera, seq, timestamp_us, fmt, payload = frame
+            if seq is None:
+                # Older senders have no header; play their frames as they come.
+                legacy_seq += 1
+                seq, timestamp_us = legacy_seq, int(arrival * 1e6)
+            if relay is not None:
+                # The bytes as they arrived; viewers decode them.
+                if fmt != FORMAT_LUMA:
+                    relay.push(addr[0], camera, seq, payload)
+                continue
+            stream = streams.get(camera)
+            if stream is None:
+                stream = streams[camera] = CameraStream(camera)
+            stream.push(seq, timestamp_us, fmt, payload, arrival)
+
+
+def stereo_pair():
+    left, right = streams.get(0), streams.get(1)
+    if left is None or right is None or left.latest is None:
+        return None
+    _, timestamp_us, frame = left.latest
+    best = min(list(right.history), key=lambda item: abs(item[0] - timestamp_us), default=None)
+    if best is None or abs(best[0] - timestamp_us) > STEREO_TOLERANCE * 1e6 or best[1].shape != frame.shape:
+        return None
+    return np.hstack((frame, best[1]))
+
+
+threading.Thread(target=receive, daemon=True).start()
+
+if relay is not None:
+    server = RelayServer(('', RELAY_PORT), relay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    while True:
+        time.sleep(STATS_INTERVAL)
+        for key, stream in relay.stats()['streams'].items():
+            print(f"{key}: {stream}")
+        for sender, assembler in list(assemblers.items()):
+            print(f"fec {sender[0]}: {assembler.stats()}")
+        print(f"receive: {receiver.stats()}")
+
+last_stats = time.monotonic()
+shown_stereo = None
 while True:
-    data, addr = sock.recvfrom(65507)
-    
-    np_arr = np.frombuffer(data, dtype=np.uint8)
-    frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+    # Only the windows live on this thread; each camera decodes on its own.
+    for camera, stream in list(streams.items()):
+        latest = stream.latest
+        if latest is not None and latest is not stream.shown:
+            stream.shown = latest
+            cv2.imshow(f"Camera {camera}", latest[2])
+
+    left = streams.get(0)
+    if STEREO and left is not None and left.latest is not shown_stereo:
+        shown_stereo = left.latest
+        pair = stereo_pair()
+        if pair is not None:
+            cv2.imshow("Stereo", pair)
 
-    if frame is not None:
-        cv2.imshow("Received Frame", frame)
+    if time.monotonic() - last_stats >= STATS_INTERVAL:
+        last_stats = time.monotonic()
+        for camera, stream in list(streams.items()):
+            print(f"camera {camera}: {stream.stats()}")
+        for sender, assembler in list(assemblers.items()):
+            print(f"fec {sender[0]}: {assembler.stats()}")
+        print(f"receive: {receiver.stats()}")
 
-    if cv2.waitKey(1) & 0xFF == 27:
+    if cv2.waitKey(5) & 0xFF == 27:
         break
 
 sock.close()
+for stream in streams.values():
+    stream.close()
 cv2.destroyAllWindows()
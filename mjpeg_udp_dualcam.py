@@ -1,12 +1,28 @@
+import json
 import socket
 import time
 import numpy as np
 import cv2
+import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 import tornado.gen
 import threading
-from picamera2 import Picamera2
+from picamera2 import MappedArray, Picamera2
+
+from buffers import ArrayPool, tracker
+from change_gate import ChangeGate
+from fec import FecController
+from jpeg_encoder import encoder
+from udp_proto import CHUNK_SIZE, read_feedback, send_frame
+
+CHANGE_GATE = True
+KEEPALIVE_FPS = 1.0
+# Send parity chunks with every frame, between FEC_MIN_OVERHEAD and
+# FEC_MAX_OVERHEAD of the data depending on the loss the receiver reports.
+FEC = True
+FEC_MIN_OVERHEAD = 0.1
+FEC_MAX_OVERHEAD = 0.5
 
 connectedDevices = {}
 
@@ -33,23 +49,53 @@ picam2.start()
 time.sleep(2)
 
 device_ids = ['camera1', 'camera2']
+gates = {device_id: ChangeGate(keepalive_fps=KEEPALIVE_FPS) if CHANGE_GATE else None
+         for device_id in device_ids}
+# Frames sent per camera, which is also each camera's sequence number.
+frame_counts = {device_id: 0 for device_id in device_ids}
+pool = ArrayPool()
+fec = FecController(FEC_MIN_OVERHEAD, FEC_MAX_OVERHEAD) if FEC else None
+
+
+def publish(device_id, picam):
+    # Work on the camera buffer in place instead of copying it out with
+    # capture_array(), and resize into a buffer reused every frame.
+    request = picam.capture_request()
+    try:
+        with MappedArray(request, 'main') as m:
+            gate = gates[device_id]
+            if gate is not None:
+                gate.observe_rgb(m.array)
+                if not gate.admit():
+                    return
+            frame_resized = cv2.resize(m.array, (320, 240), dst=pool.get(device_id, (240, 320, 3)))
+        timestamp_us = request.get_metadata()['SensorTimestamp'] // 1000
+    finally:
+        request.release()
+
+    # tornado writes bytes only.
+    data = encoder('udp').encode(frame_resized).tobytes()
+    tracker.allocated(len(data))
+    tracker.frame()
+    parity = 0
+    if fec is not None:
+        feedback = read_feedback(sock)
+        if feedback is not None:
+            # Luma modes aren't implemented here; only the loss is used.
+            fec.loss = feedback[0]
+        parity = fec.parity_for(-(-len(data) // CHUNK_SIZE))
+    send_frame(sock, ('192.168.0.138', 7000), frame_counts[device_id], timestamp_us, data, parity,
+               camera=device_ids.index(device_id))
+    frame_counts[device_id] += 1
+    connectedDevices[device_id] = {'image': data, 'seq': frame_counts[device_id]}
 
 
 def udp_client():
     global connectedDevices
     try:
         while True:
-            frame1 = picam1.capture_array()
-            frame1_resized = cv2.resize(frame1, (320, 240))
-            _, buffer1 = cv2.imencode(".jpg", frame1_resized)
-            sock.sendto(buffer1.tobytes(), ('192.168.0.138', 7000))
-            connectedDevices[device_ids[0]] = {'image': buffer1.tobytes()}
-
-            frame2 = picam2.capture_array()
-            frame2_resized = cv2.resize(frame2, (320, 240))
-            _, buffer2 = cv2.imencode(".jpg", frame2_resized)
-            sock.sendto(buffer2.tobytes(), ('192.168.0.138', 7000))
-            connectedDevices[device_ids[1]] = {'image': buffer2.tobytes()}
+            publish(device_ids[0], picam1)
+            publish(device_ids[1], picam2)
 
     except KeyboardInterrupt:
         print("stop")
@@ -62,11 +108,12 @@ def udp_client():
 class StreamHandler(tornado.web.RequestHandler):
     @tornado.gen.coroutine
     def get(self, slug):
-        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate, >
+        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate, pre-check=0, post-check=0, max-age=0')
         self.set_header('Pragma', 'no-cache')
-        self.set_header('Content-Type', 'multipart/x-mixed-replace;boundary=--j>
+        self.set_header('Content-Type', 'multipart/x-mixed-replace;boundary=--jpgboundary')
         self.set_header('Connection', 'close')
 
+        last_seq = None
         while True:
             client = connectedDevices.get(slug, None)
             if client is None:
@@ -74,8 +121,10 @@ class StreamHandler(tornado.web.RequestHandler):
                 return
 
             jpgData = client.get('image', None)
-            if jpgData is None:
+            if jpgData is None or client['seq'] == last_seq:
+                yield tornado.gen.sleep(0.005)
                 continue
+            last_seq = client['seq']
 
 
             self.write(b"--jpgboundary\r\n")
@@ -85,6 +134,20 @@ class StreamHandler(tornado.web.RequestHandler):
             yield self.flush()
 
 
+class StatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        stats = {}
+        for device_id in device_ids:
+            stats[device_id] = {'frames': frame_counts[device_id]}
+            if gates[device_id] is not None:
+                stats[device_id]['gate'] = gates[device_id].stats()
+        if fec is not None:
+            stats['fec'] = fec.stats()
+        stats['allocations'] = tracker.stats()
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(stats))
+
+
 class IndexHandler(tornado.web.RequestHandler):
     def get(self):
         deviceIds = [str(d) for d in connectedDevices]
@@ -137,6 +200,7 @@ class IndexHandler(tornado.web.RequestHandler):
 
 application = tornado.web.Application([
     (r"/video_feed/([^/]+)", StreamHandler),
+    (r"/stats", StatsHandler),
     (r"/", IndexHandler),
 ])
 
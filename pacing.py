@@ -0,0 +1,66 @@
+# Per-client frame-rate decimation over the shared encoded frames.
+#
+# ?every=k sends every k-th frame; ?fps=N sends frames on a fixed schedule
+# of capture timestamps, picking whichever frame lands closest to each due
+# time so the delivered rate stays even without re-encoding anything.
+
+from urllib.parse import parse_qs
+
+
+class FramePacer:
+    def __init__(self, fps=None, every=None):
+        self.fps = fps
+        self.every = every
+        self.seen = 0
+        self.sent = 0
+        self.next_due = None
+        self.frame_interval = None
+        self.last_frame = None
+        self.last_sent = None
+        self.sent_interval = None
+
+    @classmethod
+    def from_query(cls, query):
+        # Raises ValueError for values that aren't numbers; answer 400.
+        params = parse_qs(query)
+        fps = float(params['fps'][0]) if 'fps' in params else None
+        every = int(params['every'][0]) if 'every' in params else None
+        return cls(fps if fps and fps > 0 else None, every if every and every > 1 else None)
+
+    def admit(self, timestamp, max_fps=None):
+        if self.last_frame is not None:
+            delta = timestamp - self.last_frame
+            self.frame_interval = delta if self.frame_interval is None else 0.9 * self.frame_interval + 0.1 * delta
+        self.last_frame = timestamp
+        self.seen += 1
+
+        if self.every and (self.seen - 1) % self.every:
+            return False
+
+        rates = [rate for rate in (self.fps, max_fps) if rate]
+        if rates:
+            interval = 1.0 / min(rates)
+            # Take a frame up to half a source frame early rather than a whole
+            # frame late; that keeps the spacing within half a frame of ideal.
+            slack = (self.frame_interval or 0.0) / 2
+            if self.next_due is not None and timestamp < self.next_due - slack:
+                return False
+            if self.next_due is None or timestamp - self.next_due > interval:
+                self.next_due = timestamp
+            self.next_due += interval
+
+        if self.last_sent is not None:
+            delta = timestamp - self.last_sent
+            self.sent_interval = delta if self.sent_interval is None else 0.9 * self.sent_interval + 0.1 * delta
+        self.last_sent = timestamp
+        self.sent += 1
+        return True
+
+    def stats(self):
+        return {
+            'fps': self.fps,
+            'every': self.every,
+            'delivered_fps': round(1.0 / self.sent_interval, 2) if self.sent_interval else 0.0,
+            'sent': self.sent,
+            'skipped': self.seen - self.sent,
+        }
@@ -0,0 +1,147 @@
+# Records JPEG frames so field problems can be replayed later.
+#
+# A recording is two files: <path>.seg holds the JPEG frames back to back
+# and is only ever appended to; <path>.idx is a fixed-size record per frame
+# (offset, capture timestamp, size). Readers mmap both, so seeking to a
+# frame or a timestamp is a lookup or a binary search over the index with
+# no scanning and no copies.
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+INDEX_MAGIC = b'MRIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sII4x')
+RECORD = struct.Struct('<QQI4x')
+
+
+class Recorder:
+    def __init__(self, path, flush_every=25):
+        self.path = path
+        self.segment = open(path + '.seg', 'ab')
+        self.index = open(path + '.idx', 'ab')
+        if self.index.tell() == 0:
+            self.index.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, RECORD.size))
+        self.offset = self.segment.tell()
+        self.flush_every = flush_every
+        self.frames = 0
+        self.lock = threading.Lock()
+
+    def write(self, frame, timestamp_us=None):
+        if timestamp_us is None:
+            timestamp_us = time.monotonic_ns() // 1000
+        with self.lock:
+            size = self.segment.write(frame)
+            self.index.write(RECORD.pack(self.offset, timestamp_us, size))
+            self.offset += size
+            self.frames += 1
+            if self.frames % self.flush_every == 0:
+                # Segment before index, so an indexed frame is always on disk.
+                self.segment.flush()
+                self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.segment.close()
+            self.index.close()
+
+
+class Recording:
+    def __init__(self, path):
+        self.path = path
+        self.segment_file = open(path + '.seg', 'rb')
+        self.index_file = open(path + '.idx', 'rb')
+        self.segment = None
+        self.index = None
+        self.count = 0
+        self.refresh()
+        magic, version, record_size = INDEX_HEADER.unpack_from(self.index)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or record_size != RECORD.size:
+            raise ValueError(f'{path}.idx is not a recording index')
+
+    def refresh(self):
+        # Pick up frames appended since the files were mapped.
+        index_size = os.fstat(self.index_file.fileno()).st_size
+        segment_size = os.fstat(self.segment_file.fileno()).st_size
+        if index_size < INDEX_HEADER.size or segment_size == 0:
+            raise ValueError(f'{self.path} is empty')
+        self.index = mmap.mmap(self.index_file.fileno(), index_size, access=mmap.ACCESS_READ)
+        self.segment = mmap.mmap(self.segment_file.fileno(), segment_size, access=mmap.ACCESS_READ)
+        self.count = (index_size - INDEX_HEADER.size) // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        return RECORD.unpack_from(self.index, INDEX_HEADER.size + i * RECORD.size)
+
+    def frame(self, i):
+        offset, timestamp_us, size = self.entry(i)
+        return memoryview(self.segment)[offset:offset + size], timestamp_us
+
+    def seek(self, timestamp_us):
+        # First frame captured at or after timestamp_us.
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[1] < timestamp_us:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class ReplayCamera:
+    # Stands in for Picamera2 in the servers: start_recording() feeds the
+    # recorded JPEGs to the output at recorded pace times speed, or as fast
+    # as possible with speed=0.
+    def __init__(self, path, speed=1.0, loop=True):
+        self.recording = Recording(path)
+        self.speed = speed
+        self.loop = loop
+        self.camera_controls = {'ScalerCrop': ((0, 0, 0, 0), (0, 0, 0, 0), (0, 0, 0, 0))}
+        self.pre_callback = None
+        self.post_callback = None
+        self.running = False
+        self.thread = None
+
+    def set_controls(self, controls):
+        pass
+
+    def frames(self, start=0):
+        i = start
+        while True:
+            if i >= len(self.recording):
+                if not self.loop:
+                    return
+                i = 0
+            started = time.monotonic()
+            first = self.recording.entry(i)[1]
+            while i < len(self.recording):
+                frame, timestamp_us = self.recording.frame(i)
+                if self.speed > 0:
+                    delay = started + (timestamp_us - first) / 1e6 / self.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                yield frame, timestamp_us
+                i += 1
+
+    def start_recording(self, encoder, output):
+        self.running = True
+
+        def run():
+            for frame, _ in self.frames():
+                if not self.running:
+                    break
+                output.write(frame)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop_recording(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
@@ -0,0 +1,165 @@
+# Cuts the region the headset is looking at out of the full-resolution main
+# stream, so that region can be sent sharper than the lores stream around it.
+#
+# The callback runs on the camera thread and only copies the ROI planes out
+# of the YUV420 request buffer; conversion and JPEG encoding happen on a
+# separate thread so a slow encode never holds up the camera.
+#
+# There is one view per camera, not one per viewer: the ROI is cut and
+# encoded once per frame for every client, so a single operator steers it
+# and whoever posts /view last wins.
+
+import math
+import time
+from threading import Condition, Lock, Thread
+
+import numpy as np
+
+from jpeg_encoder import encoder
+
+try:
+    from picamera2 import MappedArray
+except ImportError:
+    MappedArray = None
+
+
+def to_source(x, y, rotation):
+    # The page rotates each image; map a point on screen back to the frame.
+    return {
+        0: (x, y),
+        90: (y, 1 - x),
+        180: (1 - x, 1 - y),
+        270: (1 - y, x),
+    }[rotation % 360]
+
+
+def roi_rect(frame_size, centre, roi_size):
+    width, height = frame_size
+    roi_width = min(roi_size[0], width) & ~1
+    roi_height = min(roi_size[1], height) & ~1
+    x = int(centre[0] * width - roi_width / 2)
+    y = int(centre[1] * height - roi_height / 2)
+    x = min(max(x, 0), width - roi_width) & ~1
+    y = min(max(y, 0), height - roi_height) & ~1
+    return (x, y, roi_width, roi_height)
+
+
+def to_display(x, y, rotation):
+    return {
+        0: (x, y),
+        90: (1 - y, x),
+        180: (1 - x, 1 - y),
+        270: (y, 1 - x),
+    }[rotation % 360]
+
+
+def display_rect(rect, frame_size, rotation):
+    x, y, width, height = rect
+    corners = [to_display(cx / frame_size[0], cy / frame_size[1], rotation)
+               for cx, cy in ((x, y), (x + width, y + height))]
+    left = min(c[0] for c in corners)
+    top = min(c[1] for c in corners)
+    return [left, top, max(c[0] for c in corners) - left, max(c[1] for c in corners) - top]
+
+
+def cut_i420(array, frame_height, rect, buffer):
+    # array is a YUV420 buffer as mapped by picamera2: frame_height rows of
+    # Y followed by the U and V planes, each packing two chroma rows per row.
+    x, y, width, height = rect
+    stride = array.shape[1]
+    quarter = frame_height // 4
+    chroma_size = frame_height // 2 * stride // 2
+    u = array[frame_height:frame_height + quarter].reshape(-1)[:chroma_size]
+    v = array[frame_height + quarter:frame_height + 2 * quarter].reshape(-1)[:chroma_size]
+    u = u.reshape(frame_height // 2, stride // 2)
+    v = v.reshape(frame_height // 2, stride // 2)
+
+    buffer[:height] = array[y:y + height, x:x + width]
+    chroma = buffer[height:].reshape(2, height // 2, width // 2)
+    chroma[0] = u[y // 2:(y + height) // 2, x // 2:(x + width) // 2]
+    chroma[1] = v[y // 2:(y + height) // 2, x // 2:(x + width) // 2]
+    return buffer
+
+
+class ViewTracker:
+    def __init__(self, rotation=0):
+        self.rotation = rotation
+        self.centre = (0.5, 0.5)
+        self.lock = Lock()
+
+    def update(self, x, y):
+        if not (math.isfinite(x) and math.isfinite(y)):
+            raise ValueError('view centre must be finite')
+        x = min(max(x, 0.0), 1.0)
+        y = min(max(y, 0.0), 1.0)
+        with self.lock:
+            self.centre = to_source(x, y, self.rotation)
+
+    def get(self):
+        with self.lock:
+            return self.centre
+
+
+class RoiStream:
+    def __init__(self, output, view, main_size, roi_size=(512, 512), buffers=3):
+        self.output = output
+        self.view = view
+        self.main_size = main_size
+        self.roi_size = roi_size
+        self.rect = roi_rect(main_size, view.get(), roi_size)
+        width, height = self.rect[2], self.rect[3]
+        self.free = [np.empty((height * 3 // 2, width), np.uint8) for _ in range(buffers)]
+        self.pending = None
+        self.condition = Condition()
+        self.frames = 0
+        self.dropped = 0
+        self.encode_seconds = 0.0
+        self.encoder = encoder('roi')
+        Thread(target=self.encode_loop, daemon=True).start()
+
+    def callback(self, request):
+        if not self.output.wanted():
+            return
+        with self.condition:
+            if not self.free:
+                self.dropped += 1
+                return
+            buffer = self.free.pop()
+
+        # Read the view on every frame so a new direction shows up on the
+        # very next one.
+        rect = roi_rect(self.main_size, self.view.get(), self.roi_size)
+        with MappedArray(request, 'main') as m:
+            cut_i420(m.array, self.main_size[1], rect, buffer)
+
+        with self.condition:
+            if self.pending is not None:
+                self.free.append(self.pending[0])
+                self.dropped += 1
+            self.pending = (buffer, rect)
+            self.condition.notify()
+
+    def encode_loop(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                buffer, rect = self.pending
+                self.pending = None
+            started = time.perf_counter()
+            encoded_image = self.encoder.encode_i420(buffer, rect[2], rect[3])
+            self.encode_seconds += time.perf_counter() - started
+            with self.condition:
+                self.free.append(buffer)
+            self.rect = rect
+            self.frames += 1
+            self.output.write(encoded_image)
+
+    def stats(self):
+        frames = max(self.frames, 1)
+        return {
+            'rect': self.rect,
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'encode_ms': round(self.encode_seconds / frames * 1000, 2),
+        }
@@ -0,0 +1,74 @@
+# Picks the sensor mode for a camera instead of leaving it to libcamera,
+# which goes by the main stream size alone.
+#
+# Every frame crosses the CSI link at the mode's size and bit depth and is
+# read by the ISP whatever the streams are scaled down to, so the cheapest
+# mode is the one with the fewest bits per second at the frame rate we run
+# at that still:
+#
+#   - runs at least that fast,
+#   - sees the field of view we need, a fraction of the full pixel array in
+#     each direction (binned modes see all of it, cropped modes less), and
+#   - has enough pixels across that field of view for the largest output.
+#
+# picam.sensor_modes reconfigures the camera to list the modes, so pick
+# before configuring.
+
+import logging
+
+FULL_FOV = (1.0, 1.0)
+# 8-bit modes are cheaper but lose tonal range; only used when nothing
+# deeper fits.
+MIN_BIT_DEPTH = 10
+
+# name: the mode select() picked and its CSI bandwidth, for /stats.
+chosen = {}
+
+
+def field_of_view(mode, full_size):
+    _, _, width, height = mode['crop_limits']
+    return width / full_size[0], height / full_size[1]
+
+
+def bandwidth(mode, fps):
+    # Bits per second on the CSI link, before packing overhead.
+    return mode['size'][0] * mode['size'][1] * mode['bit_depth'] * fps
+
+
+def choose_mode(modes, output_size, fps, full_size, fov=FULL_FOV, min_bit_depth=MIN_BIT_DEPTH):
+    def suitable(mode):
+        mode_fov = field_of_view(mode, full_size)
+        if mode['fps'] < fps or mode_fov[0] < fov[0] - 0.01 or mode_fov[1] < fov[1] - 0.01:
+            return False
+        # Pixels the mode has across the part of the view that's used.
+        return all(size * wanted / seen >= output
+                   for size, wanted, seen, output in zip(mode['size'], fov, mode_fov, output_size))
+
+    candidates = [mode for mode in modes if suitable(mode)]
+    if not candidates:
+        return None
+    candidates = [mode for mode in candidates if mode['bit_depth'] >= min_bit_depth] or candidates
+    return min(candidates, key=lambda mode: (bandwidth(mode, fps), -mode['bit_depth']))
+
+
+def select(picam, output_size, fps, fov=FULL_FOV, name='camera'):
+    # Keyword arguments for create_video_configuration(): the sensor mode
+    # and frame duration, or just the frame rate when no mode fits.
+    full_size = picam.camera_properties['PixelArraySize']
+    mode = choose_mode(picam.sensor_modes, output_size, fps, full_size, fov)
+    if mode is None:
+        logging.warning('%s: no sensor mode gives %dx%d at %g fps; leaving it to libcamera',
+                        name, output_size[0], output_size[1], fps)
+        return {'controls': {'FrameRate': fps}}
+    chosen[name] = {'size': list(mode['size']), 'bit_depth': mode['bit_depth'], 'max_fps': mode['fps'],
+                    'csi_bits_per_second': round(bandwidth(mode, fps))}
+    fov_x, fov_y = field_of_view(mode, full_size)
+    logging.info('%s: sensor mode %dx%d %d-bit (up to %.0f fps, %.0f%% x %.0f%% of the sensor), '
+                 '%.0f Mbit/s at %g fps', name, mode['size'][0], mode['size'][1], mode['bit_depth'], mode['fps'],
+                 fov_x * 100, fov_y * 100, bandwidth(mode, fps) / 1e6, fps)
+    frame_us = int(1e6 / fps)
+    return {
+        'sensor': {'output_size': mode['size'], 'bit_depth': mode['bit_depth']},
+        'controls': {'FrameDurationLimits': (frame_us, frame_us)},
+    }
+
@@ -0,0 +1,142 @@
+# Keeps streaming handler threads from leaking.
+#
+# A handler waiting on a camera that stopped producing frames, or writing to
+# a client that vanished without closing the connection, used to block
+# forever. Handlers now wait for frames in bounded slices and report
+# progress after every frame they send or skip; the watchdog shuts down the
+# socket of any handler with no progress for stall_seconds, which fails a
+# blocked send straight away.
+#
+# Time spent waiting for a frame counts for less: a client paced to one
+# frame a minute, a gated camera looking at a still scene or a paused sender
+# are all healthy, so a waiting handler is only reaped after max_wait
+# seconds without a frame (wait_stalls * stall_seconds). Meanwhile each wait
+# slice checks whether the client has hung up, and TCP keepalives turn a
+# client that vanished without closing the connection into a socket error
+# within KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT seconds.
+
+import logging
+import select
+import socket
+import threading
+import time
+
+# Slice for condition waits, and send/receive timeout for client sockets.
+FRAME_WAIT = 1.0
+SEND_TIMEOUT = 10
+STALL_SECONDS = 30
+WAIT_STALLS = 10
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+
+class Stalled(Exception):
+    pass
+
+
+def keepalive(connection):
+    try:
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Linux only; elsewhere the system defaults (hours) apply.
+        for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                              ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+            if hasattr(socket, option):
+                connection.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    except OSError as e:
+        logging.warning('Could not enable TCP keepalive: %s', str(e))
+
+
+class Watch:
+    def __init__(self, watchdog, handler):
+        self.watchdog = watchdog
+        self.handler = handler
+        self.last = time.monotonic()
+        self.waiting = False
+        self.reaped = False
+
+    def __enter__(self):
+        keepalive(self.handler.connection)
+        self.watchdog.register(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.watchdog.unregister(self)
+
+    def wait(self, condition):
+        # Use in place of condition.wait(), holding the condition.
+        self.waiting = True
+        try:
+            while not condition.wait(self.watchdog.frame_wait):
+                self.check()
+                self.check_client()
+        finally:
+            self.waiting = False
+            self.last = time.monotonic()
+
+    def check(self):
+        if self.reaped:
+            limit = self.watchdog.max_wait if self.waiting else self.watchdog.stall_seconds
+            raise Stalled(f'no progress for {limit}s')
+
+    def check_client(self):
+        # A closed connection reads as end of file; peek so a request the
+        # client sent meanwhile stays unread.
+        connection = self.handler.connection
+        if select.select([connection], [], [], 0)[0] and connection.recv(1, socket.MSG_PEEK) == b'':
+            raise ConnectionAbortedError('client closed the connection')
+
+    def progress(self):
+        self.last = time.monotonic()
+
+
+class Watchdog:
+    def __init__(self, stall_seconds=STALL_SECONDS, frame_wait=FRAME_WAIT, wait_stalls=WAIT_STALLS):
+        self.stall_seconds = stall_seconds
+        self.frame_wait = frame_wait
+        self.max_wait = stall_seconds * wait_stalls
+        self.watches = set()
+        self.reaped = 0
+        self.reaped_waiting = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def watch(self, handler):
+        return Watch(self, handler)
+
+    def register(self, watch):
+        with self.lock:
+            self.watches.add(watch)
+
+    def unregister(self, watch):
+        with self.lock:
+            self.watches.discard(watch)
+
+    def run(self):
+        while True:
+            time.sleep(min(self.stall_seconds / 4, 5))
+            now = time.monotonic()
+            with self.lock:
+                stalled = [w for w in self.watches
+                           if not w.reaped and now - w.last > (self.max_wait if w.waiting else self.stall_seconds)]
+            for watch in stalled:
+                watch.reaped = True
+                self.reaped += 1
+                self.reaped_waiting += watch.waiting
+                logging.warning('Reaping stalled streaming client %s after %.0fs',
+                                watch.handler.client_address, now - watch.last)
+                try:
+                    watch.handler.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'live': len(self.watches),
+                'waiting': sum(1 for w in self.watches if w.waiting),
+                'reaped': self.reaped,
+                'reaped_waiting': self.reaped_waiting,
+                'threads': threading.active_count(),
+            }
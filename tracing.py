@@ -0,0 +1,164 @@
+# Per-frame stage tracing, for finding out which stage made a stream stutter
+# when the counters in /stats only say that it did.
+#
+# Stages of sampled frames are recorded as spans tagged with the stream,
+# frame ID and client, and exported as Chrome trace JSON, which
+# chrome://tracing and ui.perfetto.dev open as a timeline per thread.
+# Garbage collections are recorded on whatever thread they stall.
+#
+# Frame IDs are the sensor timestamp in microseconds where there is one, so
+# every stage of a frame makes the same sampling decision: frames whose ID
+# is a multiple of sample_every are traced.
+#
+# Each thread appends to its own ring of capacity events, so recording takes
+# no lock; the oldest events are overwritten. A span that crosses threads or
+# overlaps the next frame's (capture, distortion in the pool) is an async
+# event, drawn on its own track.
+#
+# Disabled, sampled() is one attribute check and nothing else is called.
+
+import gc
+import json
+import logging
+import os
+import threading
+import time
+
+SAMPLE_EVERY = 10
+CAPACITY = 4096
+DUMP_INTERVAL = 10.0
+DUMP_KEEP = 5
+
+
+def now():
+    return time.monotonic_ns()
+
+
+class Ring:
+    def __init__(self, capacity):
+        self.thread = threading.current_thread().name
+        self.tid = threading.get_native_id()
+        self.events = [None] * capacity
+        self.count = 0
+
+    def append(self, event):
+        self.events[self.count % len(self.events)] = event
+        self.count += 1
+
+    def snapshot(self):
+        # list() of a list is atomic under the GIL; the owner may overwrite
+        # a slot meanwhile, which only loses that slot's old event.
+        return [event for event in list(self.events) if event is not None]
+
+
+class Tracer:
+    def __init__(self, enabled=False, sample_every=SAMPLE_EVERY, capacity=CAPACITY):
+        self.enabled = enabled
+        self.sample_every = max(1, sample_every)
+        self.capacity = capacity
+        self.local = threading.local()
+        self.rings = []
+        self.lock = threading.Lock()
+        self.gc_started = None
+        if enabled:
+            gc.callbacks.append(self.on_gc)
+
+    def sampled(self, frame_id):
+        return self.enabled and frame_id is not None and frame_id % self.sample_every == 0
+
+    def ring(self):
+        ring = getattr(self.local, 'ring', None)
+        if ring is None:
+            ring = self.local.ring = Ring(self.capacity)
+            with self.lock:
+                self.rings.append(ring)
+        return ring
+
+    def span(self, name, start_ns, end_ns, **args):
+        self.ring().append(('X', name, start_ns, end_ns, args))
+
+    def async_span(self, name, start_ns, end_ns, **args):
+        self.ring().append(('async', name, start_ns, end_ns, args))
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_started = now()
+        elif self.gc_started is not None:
+            self.span('gc', self.gc_started, now(), generation=info['generation'], collected=info['collected'])
+            self.gc_started = None
+
+    def events(self, since_ns=None, until_ns=None):
+        with self.lock:
+            rings = list(self.rings)
+        pid = os.getpid()
+        events = [{'ph': 'M', 'name': 'process_name', 'pid': pid, 'args': {'name': 'camera_integ'}}]
+        for ring in rings:
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': ring.tid,
+                           'args': {'name': ring.thread}})
+            for phase, name, start, end, args in ring.snapshot():
+                if since_ns is not None and end <= since_ns or until_ns is not None and end > until_ns:
+                    continue
+                if phase == 'X':
+                    events.append({'ph': 'X', 'name': name, 'cat': 'stage', 'pid': pid, 'tid': ring.tid,
+                                   'ts': start / 1000, 'dur': (end - start) / 1000, 'args': args})
+                else:
+                    # Async pairs match on cat, name and id.
+                    key = f"{args.get('stream')}/{args.get('frame')}"
+                    events.append({'ph': 'b', 'name': name, 'cat': 'frame', 'id': key, 'pid': pid,
+                                   'tid': ring.tid, 'ts': start / 1000, 'args': args})
+                    events.append({'ph': 'e', 'name': name, 'cat': 'frame', 'id': key, 'pid': pid,
+                                   'tid': ring.tid, 'ts': end / 1000})
+        return events
+
+    def export(self, since_ns=None, until_ns=None):
+        return json.dumps({'traceEvents': self.events(since_ns, until_ns), 'displayTimeUnit': 'ms'})
+
+    def stats(self):
+        with self.lock:
+            rings = list(self.rings)
+        recorded = sum(ring.count for ring in rings)
+        return {
+            'enabled': self.enabled,
+            'sample_every': self.sample_every,
+            'threads': len(rings),
+            'recorded': recorded,
+            'overwritten': sum(max(ring.count - self.capacity, 0) for ring in rings),
+        }
+
+
+class TraceWriter:
+    # Writes the events that ended in the last interval seconds to path
+    # every interval, rotating path -> path.1 -> ... -> path.<keep>, so the
+    # files always cover the last (keep + 1) * interval seconds.
+    def __init__(self, tracer, path, interval=DUMP_INTERVAL, keep=DUMP_KEEP):
+        self.tracer = tracer
+        self.path = path
+        self.interval = interval
+        self.keep = keep
+        self.dumps = 0
+        self.failed = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        since = now()
+        while True:
+            time.sleep(self.interval)
+            until = now()
+            try:
+                self.rotate()
+                with open(self.path, 'w') as f:
+                    f.write(self.tracer.export(since, until))
+                self.dumps += 1
+            except OSError as e:
+                self.failed += 1
+                logging.warning('Could not write trace %s: %s', self.path, str(e))
+            since = until
+
+    def rotate(self):
+        for index in range(self.keep, 0, -1):
+            source = f'{self.path}.{index - 1}' if index > 1 else self.path
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index}')
+
+    def stats(self):
+        return {'path': self.path, 'dumps': self.dumps, 'failed': self.failed}
@@ -0,0 +1,187 @@
+# Header carried in front of every datagram on the UDP video stream.
+#
+#   magic    2s  b'MR'
+#   version  B
+#   flags    B   payload format: FORMAT_JPEG, or FORMAT_LUMA (see luma.py)
+#   seq      I   frame sequence number, per sender
+#   capture  Q   capture timestamp in microseconds, sender clock
+#
+# Version 2 splits each frame into chunks that fit one MTU, so losing one
+# IP fragment no longer loses the whole frame, and adds
+#
+#   length   I   frame length in bytes
+#   index    H   chunk index; data chunks first, then parity chunks
+#   data     H   number of data chunks in the frame
+#   parity   H   number of parity chunks in the frame (see fec.py)
+#
+# Version 3 adds, so one receiver can take several cameras,
+#
+#   camera   B   camera number on the sender; seq counts per camera
+#   (pad)    x
+#
+# Version 2 datagrams are camera 0. Version 1 datagrams carry a whole frame
+# after the common header.
+# Datagrams without the magic are treated as bare JPEGs from older senders.
+#
+# The receiver reports the chunk loss it measures back to the sender's
+# address in a FEEDBACK datagram, and the sender sizes its parity from it.
+# The same datagram carries the stream mode the receiver wants (luma.MODES).
+
+import socket
+import struct
+import numpy as np
+
+import fec
+
+MAGIC = b'MR'
+VERSION = 3
+HEADER = struct.Struct('!2sBBIQ')
+CHUNK_HEADER = struct.Struct('!IHHHBx')
+CHUNK_HEADER_V2 = struct.Struct('!IHHH')
+# 1500 byte MTU less IP, UDP and our headers.
+CHUNK_SIZE = 1500 - 20 - 8 - HEADER.size - CHUNK_HEADER.size
+
+FORMAT_JPEG = 0
+FORMAT_LUMA = 1
+
+FEEDBACK_MAGIC = b'MF'
+FEEDBACK = struct.Struct('!2sBBf')
+
+
+def send_frame(sock, address, seq, timestamp_us, payload, parity=0, chunk_size=CHUNK_SIZE, fmt=FORMAT_JPEG,
+               camera=0):
+    payload = memoryview(payload).cast('B')
+    length = len(payload)
+    data_chunks = max(1, -(-length // chunk_size))
+    # Frames too big for the parity asked for get what fits (see fec.py);
+    # every chunk, data or parity, must carry the same count.
+    parity = min(parity, fec.max_parity(data_chunks))
+    prefix = HEADER.pack(MAGIC, VERSION, fmt, seq & 0xFFFFFFFF, timestamp_us)
+    # Scatter/gather sends, so the JPEG isn't copied just to add headers.
+    for index in range(data_chunks):
+        chunk = payload[index * chunk_size:(index + 1) * chunk_size]
+        sock.sendmsg([prefix, CHUNK_HEADER.pack(length, index, data_chunks, parity, camera), chunk], [], 0, address)
+    if parity:
+        padded = np.zeros(data_chunks * chunk_size, dtype=np.uint8)
+        padded[:length] = np.frombuffer(payload, dtype=np.uint8)
+        for row, chunk in enumerate(fec.encode(padded.reshape(data_chunks, chunk_size), parity)):
+            sock.sendmsg([prefix, CHUNK_HEADER.pack(length, data_chunks + row, data_chunks, parity, camera), chunk],
+                         [], 0, address)
+    return data_chunks
+
+
+def send_feedback(sock, address, loss, mode=0):
+    sock.sendto(FEEDBACK.pack(FEEDBACK_MAGIC, 1, mode, loss), address)
+
+
+def read_feedback(sock):
+    # Latest (loss, mode) report waiting on the sender's socket, or None.
+    feedback = None
+    while True:
+        try:
+            datagram = sock.recv(64, socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return feedback
+        except OSError:
+            # ICMP errors from an absent receiver surface here; ignore them.
+            continue
+        if len(datagram) == FEEDBACK.size and datagram[:2] == FEEDBACK_MAGIC:
+            _, _, mode, loss = FEEDBACK.unpack(datagram)
+            feedback = loss, mode
+
+
+class FrameAssembler:
+    # Collects chunks per frame and hands back (camera, seq, timestamp_us,
+    # format, payload) once a frame is complete, rebuilding lost data chunks
+    # from parity.
+    # Frames still incomplete after timeout seconds are given up on. Chunks
+    # arriving after their frame was delivered still count towards the loss
+    # estimate, which is an average over finished frames.
+    def __init__(self, timeout=0.5):
+        self.timeout = timeout
+        self.partial = {}
+        self.done = {}
+        self.loss = 0.0
+        self.frames = 0
+        self.recovered = 0
+        self.failed = 0
+        self.chunks = 0
+        self.duplicates = 0
+
+    def add(self, datagram, arrival):
+        # datagram may be a receive buffer that is reused once this returns
+        # (udp_receive.Receiver), so nothing here keeps a reference to it.
+        if len(datagram) < HEADER.size or datagram[:2] != MAGIC:
+            return 0, None, None, FORMAT_JPEG, bytes(datagram)
+        _, version, fmt, seq, timestamp_us = HEADER.unpack_from(datagram)
+        if version < 2:
+            return 0, seq, timestamp_us, FORMAT_JPEG, bytes(datagram[HEADER.size:])
+        if version == 2:
+            length, index, data_chunks, parity = CHUNK_HEADER_V2.unpack_from(datagram, HEADER.size)
+            camera, offset = 0, HEADER.size + CHUNK_HEADER_V2.size
+        else:
+            length, index, data_chunks, parity, camera = CHUNK_HEADER.unpack_from(datagram, HEADER.size)
+            offset = HEADER.size + CHUNK_HEADER.size
+        chunk = memoryview(datagram)[offset:]
+        self.chunks += 1
+        self.expire(arrival)
+
+        key = camera, seq
+        if key in self.done:
+            self.done[key][1] += 1
+            return None
+        frame = self.partial.get(key)
+        if frame is None:
+            # Chunks are copied to index * CHUNK_SIZE in one buffer per frame,
+            # so a frame from a sender with the default chunk size ends up
+            # contiguous and needs no joining.
+            frame = self.partial[key] = [arrival, timestamp_us, length, data_chunks, parity, {},
+                                         bytearray((data_chunks + parity) * CHUNK_SIZE), True]
+        chunks = frame[5]
+        if index in chunks:
+            self.duplicates += 1
+            return None
+        if len(chunk) == CHUNK_SIZE or index == data_chunks - 1 and len(chunk) < CHUNK_SIZE:
+            start = index * CHUNK_SIZE
+            frame[6][start:start + len(chunk)] = chunk
+            chunks[index] = memoryview(frame[6])[start:start + len(chunk)]
+        else:
+            frame[7] = False
+            chunks[index] = bytes(chunk)
+        if len(chunks) < data_chunks:
+            return None
+
+        del self.partial[key]
+        self.done[key] = [arrival, len(chunks), data_chunks + parity]
+        self.frames += 1
+        if all(i in chunks for i in range(data_chunks)):
+            if frame[7]:
+                payload = memoryview(frame[6])[:length]
+            else:
+                payload = b''.join(chunks[i] for i in range(data_chunks))
+        else:
+            self.recovered += 1
+            payload = fec.decode(data_chunks, chunks, len(chunks[max(chunks)])).reshape(-1)[:length].data
+        return camera, seq, timestamp_us, fmt, payload
+
+    def expire(self, now):
+        for key in [k for k, f in self.partial.items() if now - f[0] > self.timeout]:
+            _, _, _, data_chunks, parity, chunks, _, _ = self.partial.pop(key)
+            self.failed += 1
+            self.account(len(chunks), data_chunks + parity)
+        for key in [k for k, f in self.done.items() if now - f[0] > self.timeout]:
+            _, received, expected = self.done.pop(key)
+            self.account(received, expected)
+
+    def account(self, received, expected):
+        self.loss += (max(0.0, 1 - received / expected) - self.loss) / 16
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'recovered': self.recovered,
+            'failed': self.failed,
+            'chunks': self.chunks,
+            'duplicates': self.duplicates,
+            'loss': round(self.loss, 4),
+        }
@@ -0,0 +1,185 @@
+# Batched, allocation-free UDP receive.
+#
+# Datagrams are read into a ring of preallocated slots, as many as are
+# queued (up to batch) per system call with recvmmsg(2) where libc has it,
+# else one recvfrom_into() each. receive() returns memoryviews of the slots,
+# valid until the next receive(); FrameAssembler copies what it keeps.
+#
+# The socket's receive buffer is raised to rcvbuf bytes so bursts of chunks
+# from two cameras don't overflow it; the kernel caps SO_RCVBUF at
+# net.core.rmem_max unless the process may use SO_RCVBUFFORCE. stats()
+# reports the drops the kernel counted for this socket (/proc/net/udp) and
+# for all UDP sockets (RcvbufErrors, /proc/net/snmp).
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import socket
+import sys
+
+BATCH = 32
+# Enough for whole-frame datagrams from version 1 senders.
+SLOT_SIZE = 65536
+RECEIVE_BUFFER = 8 * 1024 * 1024
+
+SO_RCVBUFFORCE = 33
+MSG_WAITFORONE = 0x10000
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint32), ('sin_zero', ctypes.c_char * 8)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+def load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+def set_receive_buffer(sock, size):
+    # The kernel doubles what it's given for bookkeeping, and reports that.
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if actual < size:
+        logging.warning('Receive buffer is %d bytes, not %d; raise net.core.rmem_max', actual, size)
+    return actual
+
+
+def socket_drops(sock):
+    # The drops column of this socket's line in /proc/net/udp.
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    try:
+        with open('/proc/net/udp') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 12 and fields[9] == inode:
+                    return int(fields[-1])
+    except OSError:
+        pass
+    return None
+
+
+def rcvbuf_errors():
+    try:
+        with open('/proc/net/snmp') as f:
+            lines = [line.split() for line in f if line.startswith('Udp:')]
+        return int(lines[1][lines[0].index('RcvbufErrors')])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Receiver:
+    def __init__(self, sock, batch=BATCH, slot_size=SLOT_SIZE, rcvbuf=RECEIVE_BUFFER):
+        self.sock = sock
+        self.batch = batch
+        self.slot_size = slot_size
+        self.rcvbuf = set_receive_buffer(sock, rcvbuf) if rcvbuf else None
+        self.ring = bytearray(batch * slot_size)
+        view = memoryview(self.ring)
+        self.slots = [view[i * slot_size:(i + 1) * slot_size] for i in range(batch)]
+        self.datagrams = 0
+        self.calls = 0
+        self.truncated = 0
+        self.addresses = {}
+        self.recvmmsg = load_recvmmsg() if sock.family == socket.AF_INET else None
+        if self.recvmmsg is not None:
+            self.setup_recvmmsg()
+
+    def setup_recvmmsg(self):
+        base = ctypes.addressof(ctypes.c_char.from_buffer(self.ring))
+        self.iovecs = (iovec * self.batch)()
+        self.names = (sockaddr_in * self.batch)()
+        self.messages = (mmsghdr * self.batch)()
+        for i in range(self.batch):
+            self.iovecs[i].iov_base = base + i * self.slot_size
+            self.iovecs[i].iov_len = self.slot_size
+            header = self.messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.names[i])
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+
+    def receive(self):
+        # [(datagram, address), ...]: at least one, blocking until then.
+        if self.recvmmsg is not None:
+            return self.receive_batch()
+        received = []
+        flags = 0
+        for slot in self.slots:
+            try:
+                size, address = self.sock.recvfrom_into(slot, 0, flags)
+            except (BlockingIOError, InterruptedError):
+                break
+            self.calls += 1
+            received.append((slot[:size], address))
+            # Only the first read waits.
+            flags = socket.MSG_DONTWAIT
+        self.datagrams += len(received)
+        return received
+
+    def receive_batch(self):
+        for i in range(self.batch):
+            self.messages[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+        while True:
+            count = self.recvmmsg(self.sock.fileno(), self.messages, self.batch, MSG_WAITFORONE, None)
+            if count >= 0:
+                break
+            error = ctypes.get_errno()
+            if error != errno.EINTR:
+                raise OSError(error, os.strerror(error))
+        self.calls += 1
+        self.datagrams += count
+        received = []
+        for i in range(count):
+            size = self.messages[i].msg_len
+            if self.messages[i].msg_hdr.msg_flags & socket.MSG_TRUNC:
+                self.truncated += 1
+                continue
+            received.append((self.slots[i][:size], self.address(self.names[i])))
+        return received
+
+    def address(self, name):
+        key = (name.sin_addr, name.sin_port)
+        address = self.addresses.get(key)
+        if address is None:
+            if len(self.addresses) > 1024:
+                self.addresses.clear()
+            address = (socket.inet_ntoa(name.sin_addr.to_bytes(4, sys.byteorder)), socket.ntohs(name.sin_port))
+            self.addresses[key] = address
+        return address
+
+    def stats(self):
+        return {
+            'recvmmsg': self.recvmmsg is not None,
+            'datagrams': self.datagrams,
+            'per_call': round(self.datagrams / max(self.calls, 1), 2),
+            'truncated': self.truncated,
+            'rcvbuf': self.rcvbuf,
+            'socket_drops': socket_drops(self.sock),
+            'rcvbuf_errors': rcvbuf_errors(),
+        }
@@ -0,0 +1,146 @@
+# Re-serves the cameras arriving over UDP as MJPEG over HTTP, so viewers
+# connect to the base station and the robot sends each frame once over the
+# radio however many people watch.
+#
+# Frames are relayed as the JPEG bytes that arrived, never decoded. Each
+# sender's camera gets its own stream:
+#
+#   /                         page showing every stream
+#   /<sender>/<camera>.mjpg   MJPEG stream
+#   /<sender>/<camera>.jpg    latest frame
+#   /stats                    per-stream counters
+#
+# <sender> is the robot's IP address.
+
+import json
+import logging
+import socketserver
+from http import server
+from threading import Condition, Lock
+
+from stream_watchdog import SEND_TIMEOUT, Watchdog
+
+# Frames up to this many sequence numbers behind the last relayed one are
+# late and dropped; anything further back means the sender restarted.
+REORDER_WINDOW = 64
+
+
+class RelayOutput:
+    def __init__(self):
+        self.frame = None
+        self.seq = None
+        self.condition = Condition()
+        self.clients = 0
+        self.frames = 0
+        self.late = 0
+        self.sent = 0
+
+    def write(self, seq, frame):
+        with self.condition:
+            if self.seq is not None and (self.seq - seq) & 0xFFFFFFFF < REORDER_WINDOW:
+                self.late += 1
+                return
+            self.frame = frame
+            self.seq = seq
+            self.frames += 1
+            self.condition.notify_all()
+
+    def stats(self):
+        return {'frames': self.frames, 'late': self.late, 'clients': self.clients, 'sent': self.sent}
+
+
+class Relay:
+    def __init__(self, stall_seconds=30):
+        self.outputs = {}
+        self.lock = Lock()
+        self.watchdog = Watchdog(stall_seconds)
+
+    def push(self, sender, camera, seq, frame):
+        key = f'{sender}/{camera}'
+        output = self.outputs.get(key)
+        if output is None:
+            with self.lock:
+                output = self.outputs.setdefault(key, RelayOutput())
+        output.write(seq, frame)
+
+    def stats(self):
+        with self.lock:
+            outputs = dict(self.outputs)
+        return {
+            'streams': {key: output.stats() for key, output in outputs.items()},
+            'handlers': self.watchdog.stats(),
+        }
+
+
+class RelayHandler(server.BaseHTTPRequestHandler):
+    timeout = SEND_TIMEOUT
+
+    def do_GET(self):
+        relay = self.server.relay
+        path = self.path.partition('?')[0]
+        if path in ('/', '/index.html'):
+            with relay.lock:
+                keys = sorted(relay.outputs)
+            images = ''.join(f'<img src="/{key}.mjpg" title="{key}">\n' for key in keys)
+            self.send_content('text/html', f'<html>\n<body style="background: black">\n{images}</body>\n</html>')
+        elif path == '/stats':
+            self.send_content('application/json', json.dumps(relay.stats()))
+        elif path.endswith(('.mjpg', '.jpg')):
+            output = relay.outputs.get(path[1:].rpartition('.')[0])
+            if output is None or output.frame is None:
+                self.send_error(404)
+            elif path.endswith('.jpg'):
+                self.send_content('image/jpeg', output.frame)
+            else:
+                self.stream(relay, output)
+        else:
+            self.send_error(404)
+
+    def send_content(self, content_type, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def stream(self, relay, output):
+        self.send_response(200)
+        self.send_header('Age', 0)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+        self.end_headers()
+
+        with output.condition:
+            output.clients += 1
+        try:
+            with relay.watchdog.watch(self) as watch:
+                while True:
+                    with output.condition:
+                        watch.wait(output.condition)
+                        frame = output.frame
+                    self.wfile.write(b'--FRAME\r\n')
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', len(frame))
+                    self.end_headers()
+                    self.wfile.write(frame)
+                    self.wfile.write(b'\r\n')
+                    output.sent += len(frame)
+                    watch.progress()
+        except Exception as e:
+            logging.warning('Relay client removed: %s', str(e))
+        finally:
+            with output.condition:
+                output.clients -= 1
+
+
+class RelayServer(socketserver.ThreadingMixIn, server.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, relay):
+        self.relay = relay
+        super().__init__(address, RelayHandler)
@@ -0,0 +1,36 @@
+# Works out the ISP ScalerCrop rectangle for the part of a camera image that
+# the page actually shows, so only that region is scaled and encoded instead
+# of hiding most of a 960x720 frame behind an overflow: hidden box.
+
+VIEW_SIZE = (400, 400)
+
+# left/right values posted to /update are percentages of the view box, and
+# this value has always meant "centred" on the page.
+CENTRED_OFFSET = 17
+# The box used to show the sensor's whole short side, so shifting it showed
+# black. The window is now this many percent of the short side smaller on
+# each side, which leaves room to shift by the same amount along the axis
+# that is horizontal on screen.
+SHIFT_RANGE = CENTRED_OFFSET
+
+
+def scaler_crop(full, shift_percent, rotation=0):
+    x0, y0, width, height = full
+    short_side = min(width, height)
+    side = short_side - 2 * (SHIFT_RANGE * short_side // 100)
+    shift = shift_percent * short_side // 100
+
+    # The page rotates each image, so a horizontal shift on screen runs along
+    # a different sensor axis depending on the rotation.
+    dx, dy = {
+        0: (shift, 0),
+        90: (0, -shift),
+        180: (-shift, 0),
+        270: (0, shift),
+    }[rotation % 360]
+
+    x = x0 + (width - side) // 2 + dx
+    y = y0 + (height - side) // 2 + dy
+    x = min(max(x, x0), x0 + width - side)
+    y = min(max(y, y0), y0 + height - side)
+    return (x, y, side, side)